@@ -0,0 +1,395 @@
+# Finds all the Source 1 content under a folder in a single pass, so converting a whole game walks its content once
+# rather than once per script (and once per file extension).
+#
+# i.e.: inventory = assets.walkContent("C:\\...\\content\\tf")
+#       inventory.getFiles("material"), inventory.getFiles("model", "C:\\...\\content\\tf\\models\\props")
+#
+# loadInventory() does the same, but keeps what it found in an index file in the _imported folder. The next run only
+# looks inside folders whose modified time changed since, so big content folders (or ones on a network drive) don't
+# have to be listed from scratch every time. The index also remembers what every .vmt and .qc refers to.
+#
+# DependencyGraph puts those references together: the textures of every material, the materials of every model, and
+# which materials have to be rebuilt when a texture changes.
+
+import os
+import re
+import json
+
+import keyvalues
+import qc
+
+# File extension: kind of asset
+assetKinds = {
+    ".vmt": "material",
+    ".vtf": "texture",
+    ".tga": "texture",
+    ".mdl": "model",
+    ".qc": "qc",
+    ".vmf": "map",
+}
+
+# Name of the index loadInventory() keeps, in the root of the _imported folder
+INDEX_FILENAME = "asset_index.jsonl"
+
+# Every .vmt parameter that points at a texture
+materialTextureParameters = [
+"$basetexture",
+"$bumpmap",
+"$normalmap",
+"$envmapmask",
+"$phongexponenttexture",
+"$selfillummask",
+"$ambientoccltexture",
+"$ambientocclusiontexture",
+"$detail",
+]
+
+class AssetInventory:
+    # Every asset found under root, by kind, and every folder that was looked in.
+    # Files come in the order os.walk() gives them with its dirs and files sorted, so logs are the same every run.
+    # When it came from loadInventory(), details has the [size, mtime, references] of every file as well.
+    def __init__(self, root):
+        self.root = root
+        self.files = {kind: [] for kind in assetKinds.values()}
+        self.dirs = []
+        self.details = {}
+        self.folderEntries = {}     # index entry of every folder walked, see scanFolder()
+        self.scannedFolders = 0     # how many of them had to be listed again
+
+    def add(self, path, kind = None):
+        kind = kind or assetKinds.get(os.path.splitext(path)[1].lower())
+        if kind is not None:
+            self.files[kind].append(path)
+        return kind
+
+    def getFiles(self, kind, under = None):
+        # The files of one kind, optionally only the ones in the folder under (or that file itself)
+        if under is None:
+            return self.files[kind]
+        under = os.path.abspath(under)
+        prefix = under.rstrip(os.sep) + os.sep
+        return [path for path in self.files[kind] if path == under or path.startswith(prefix)]
+
+    def getReferences(self, path):
+        # What the file refers to, i.e. {"textures": [...], "materials": [...]} for a .vmt. None if it wasn't indexed.
+        detail = self.details.get(path)
+        return detail[2] if detail else None
+
+def normalizePath(path):
+    # Paths as .vmts and .qcs write them, made comparable: lowercase, forward slashes and no extension for textures
+    path = re.sub(r'[\\/]+', '/', path.strip().strip('"')).lower()
+    if path.endswith('.vtf'):
+        path = path[:-4]
+    return path.strip('/')
+
+def readMaterialReferences(fileName):
+    # The textures a .vmt uses and the material it includes, if it's a patch.
+    # Textures are in materialTextureParameters order, so the $basetexture (if there is one) comes first.
+    references = {"textures": [], "materials": []}
+    with open(fileName, 'r', errors='replace') as vmtFile:
+        pairs = keyvalues.parseKeyValues(vmtFile)
+    textures = []
+    for shader, block in pairs[:1]:
+        if not isinstance(block, list):
+            break
+        blocks = [block] + [value for key, value in block if isinstance(value, list) and key.lower() in ("insert", "replace")]
+        for pairsInBlock in blocks:
+            for key, value in pairsInBlock:
+                if isinstance(value, list):
+                    continue
+                key = key.lower()
+                if key in materialTextureParameters and value.strip():
+                    textures.append((materialTextureParameters.index(key), normalizePath(value)))
+                elif key == "include" and shader.lower() == "patch":
+                    references["materials"].append(normalizePath(value))
+    for parameterIndex, texture in sorted(textures, key=lambda texture: texture[0]):
+        if texture not in references["textures"]:
+            references["textures"].append(texture)
+    return references
+
+def readQcReferences(fileName):
+    # The material folders a .qc searches and the .mdl it builds, including what its includes and macros add
+    references = {"cdmaterials": [], "models": []}
+    for command, arguments in qc.getReader().read(fileName):
+        if not arguments or not isinstance(arguments[0], str):
+            continue
+        if command == "$cdmaterials":
+            references["cdmaterials"].append(normalizePath(arguments[0]))
+        elif command == "$modelname":
+            references["models"].append(normalizePath(arguments[0]))
+    return references
+
+referenceReaders = {
+    "material": readMaterialReferences,
+    "qc": readQcReferences,
+}
+
+def scanFolder(folder, mtime, withDetails):
+    # Lists one folder. Returns its index entry: {"dir", "mtime", "subdirs": [names], "files": [[name, kind, ...]]}
+    # where files only has the assets, with their size, mtime and references added if withDetails is set.
+    entry = {"dir": folder, "mtime": mtime, "subdirs": [], "files": []}
+    with os.scandir(folder) as dirEntries:
+        dirEntries = sorted(dirEntries, key=lambda dirEntry: dirEntry.name)
+    for dirEntry in dirEntries:
+        if dirEntry.is_dir(follow_symlinks=False):
+            entry["subdirs"].append(dirEntry.name)
+            continue
+        kind = assetKinds.get(os.path.splitext(dirEntry.name)[1].lower())
+        if kind is None:
+            continue
+        if not withDetails:
+            entry["files"].append([dirEntry.name, kind])
+            continue
+        stat = dirEntry.stat()
+        references = None
+        if kind in referenceReaders:
+            try:
+                references = referenceReaders[kind](dirEntry.path)
+            except (OSError, UnicodeError, qc.QCError):
+                pass
+        entry["files"].append([dirEntry.name, kind, stat.st_size, stat.st_mtime_ns, references])
+    return entry
+
+def walkContent(root, index = None):
+    # Walks root (a folder, or a single file) and returns its AssetInventory.
+    # Without an index nothing is stat'ed beyond what os.scandir already knows. With one (a dict of folder: entry,
+    # see scanFolder(), empty for a fresh start) folders whose mtime hasn't changed aren't listed again, and files
+    # get their size, mtime and references. Symlinked folders aren't followed, like os.walk().
+    root = os.path.abspath(root)
+    inventory = AssetInventory(root)
+    if not os.path.isdir(root):
+        if os.path.exists(root):
+            inventory.add(root)
+        return inventory
+
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        try:
+            mtime = os.stat(folder).st_mtime_ns if index is not None else None
+            entry = index.get(folder) if index is not None else None
+            if entry is None or entry["mtime"] != mtime:
+                entry = scanFolder(folder, mtime, index is not None)
+                inventory.scannedFolders += 1
+        except OSError:
+            continue    # unreadable folder, os.walk() skips those too
+        inventory.dirs.append(folder)
+        inventory.folderEntries[folder] = entry
+        for fileEntry in entry["files"]:
+            path = os.path.join(folder, fileEntry[0])
+            inventory.add(path, fileEntry[1])
+            if len(fileEntry) > 2:
+                inventory.details[path] = fileEntry[2:]
+        # the stack pops the last one first
+        stack.extend(os.path.join(folder, name) for name in reversed(entry["subdirs"]))
+    return inventory
+
+def splitModPath(path):
+    # (mod folder, "materials"/"models"/"maps", the rest of the path with forward slashes) for a path in a mod's
+    # content, going by the first of those folders from the top like getManifestFileName() in vmt_to_vmat.py.
+    # None if the path isn't in one of them.
+    parts = os.path.abspath(path).split(os.sep)
+    for i in range(1, len(parts)):
+        if parts[i].lower() in ("materials", "models", "maps"):
+            return os.sep.join(parts[:i]), parts[i].lower(), '/'.join(parts[i + 1:])
+    return None
+
+def getIndexFileName(root, targetFolderExtension = "_imported"):
+    # The index goes in the root of the _imported version of the mod root is in (the folder that has materials,
+    # models or maps in it). If root already is in an _imported folder, that one.
+    modPath = splitModPath(root)
+    modFolder = modPath[0] if modPath else os.path.abspath(root)
+    if not modFolder.lower().endswith(targetFolderExtension):
+        modFolder += targetFolderExtension
+    return os.path.join(modFolder, INDEX_FILENAME)
+
+def readIndex(indexFileName):
+    index = {}
+    if os.path.exists(indexFileName):
+        with open(indexFileName, 'r') as indexFile:
+            for line in indexFile:
+                if line.strip():
+                    entry = json.loads(line)
+                    index[entry["dir"]] = entry
+    return index
+
+def loadInventory(root, indexFileName = None, rescan = False):
+    # walkContent() with the index in indexFileName (getIndexFileName(root) by default), which is then updated.
+    # rescan ignores what's in the index and lists every folder again.
+    root = os.path.abspath(root)
+    if not os.path.isdir(root):
+        return walkContent(root)
+    indexFileName = indexFileName or getIndexFileName(root)
+    index = readIndex(indexFileName)
+    inventory = walkContent(root, {} if rescan else index)
+
+    # Folders outside root are kept for whoever indexes them, the ones under it are replaced by what we just found
+    prefix = root.rstrip(os.sep) + os.sep
+    removed = [folder for folder in index if (folder == root or folder.startswith(prefix)) and folder not in inventory.folderEntries]
+    if inventory.scannedFolders or removed:
+        for folder in removed:
+            del index[folder]
+        index.update(inventory.folderEntries)
+        os.makedirs(os.path.dirname(indexFileName), exist_ok=True)
+        tmpFileName = indexFileName + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpFileName, 'w') as indexFile:
+            for folder in sorted(index):
+                indexFile.write(json.dumps(index[folder]) + '\n')
+        os.replace(tmpFileName, indexFileName)
+    return inventory
+
+class DependencyGraph:
+    # Which textures every material uses and which materials every model uses, and the other way around, from the
+    # references the index keeps (or reads them, for inventories that didn't come from loadInventory()).
+    # Everything is named like .vmts and .qcs name it, lowercase with forward slashes: materials and textures relative
+    # to the materials folder without an extension (models/props/crate01), models relative to the models folder
+    # (props/crate01.mdl) and $cdmaterials folders relative to the materials folder (models/props).
+    def __init__(self, *inventories):
+        self.materialFiles = {}     # material: .vmt it's in
+        self.materialTextures = {}  # material: [textures], only the ones its own .vmt names
+        self.materialIncludes = {}  # patch material: [materials it includes]
+        self.folderMaterials = {}   # folder: [materials directly in it]
+        self.textureUsers = {}      # texture: [materials whose own .vmt names it]
+        self.includedBy = {}        # material: [patch materials that include it]
+        self.modelFiles = {}        # model: [.mdl and .qc files it comes from]
+        self.modelFolders = {}      # model: [$cdmaterials folders, in the order the engine searches them]
+        self.modelTextures = {}     # model: [material names the .mdl asks for], only for models where they're known
+        for inventory in inventories:
+            self.addInventory(inventory)
+
+    @staticmethod
+    def getName(path):
+        # The name of a file in a mod's materials or models folder, None for anything else
+        modPath = splitModPath(path)
+        if modPath is None or not modPath[2]:
+            return None
+        name = modPath[2].lower()
+        if modPath[1] == "materials":
+            name = os.path.splitext(name)[0]
+        return name
+
+    def addInventory(self, inventory):
+        for kind in ("material", "qc", "model"):
+            for path in inventory.getFiles(kind):
+                references = inventory.getReferences(path)
+                if references is None and kind in referenceReaders:
+                    try:
+                        references = referenceReaders[kind](path)
+                    except (OSError, UnicodeError, qc.QCError):
+                        references = None
+                name = self.getName(path)
+                if kind == "material" and name is not None:
+                    self.addMaterial(name, path, references or {"textures": [], "materials": []})
+                elif kind == "qc" and references:
+                    for model in references["models"]:
+                        self.addModel(model if model.endswith(".mdl") else model + ".mdl", path, references["cdmaterials"])
+                elif kind == "model" and name is not None:
+                    self.addModel(name, path)
+
+    def addMaterial(self, name, fileName, references):
+        if name in self.materialFiles:
+            return
+        self.materialFiles[name] = fileName
+        self.materialTextures[name] = references["textures"]
+        self.folderMaterials.setdefault(name.rpartition('/')[0], []).append(name)
+        for texture in references["textures"]:
+            self.textureUsers.setdefault(texture, []).append(name)
+        includes = []
+        for include in references["materials"]:
+            # patches name the .vmt they include with the materials folder and extension, see MaterialStore.resolve()
+            include = include[len("materials/"):] if include.startswith("materials/") else include
+            includes.append(os.path.splitext(include)[0])
+            self.includedBy.setdefault(includes[-1], []).append(name)
+        if includes:
+            self.materialIncludes[name] = includes
+
+    def addModel(self, name, fileName, cdmaterials = None, textures = None):
+        # cdmaterials and textures add to what's already known about the model, from its .qc or its .mdl
+        files = self.modelFiles.setdefault(name, [])
+        if fileName not in files:
+            files.append(fileName)
+        folders = self.modelFolders.setdefault(name, [])
+        for folder in cdmaterials or []:
+            if folder not in folders:
+                folders.append(folder)
+        if textures is not None:
+            self.modelTextures[name] = textures
+
+    def getTextures(self, material):
+        # Every texture the material ends up using, including the ones of the materials it includes if it's a patch
+        textures = []
+        seen = set()
+        pending = [material]
+        while pending:
+            name = pending.pop(0)
+            if name in seen:
+                continue
+            seen.add(name)
+            textures.extend(texture for texture in self.materialTextures.get(name, []) if texture not in textures)
+            pending.extend(self.materialIncludes.get(name, []))
+        return textures
+
+    def getMaterialsUsing(self, texture):
+        # Every material that has to be rebuilt when the texture changes, including patches of the ones that use it.
+        # texture can also be the full path of the .vtf or .tga.
+        if os.path.isabs(texture):
+            texture = self.getName(texture)
+        materials = []
+        pending = list(self.textureUsers.get(texture, []))
+        while pending:
+            name = pending.pop(0)
+            if name not in materials:
+                materials.append(name)
+                pending.extend(self.includedBy.get(name, []))
+        return materials
+
+    def getModelMaterials(self, model):
+        # The materials the model uses, as far as they're known. With the names from the .mdl, the first $cdmaterials
+        # folder that has each one like the engine does, otherwise everything in the $cdmaterials folders.
+        materials = []
+        folders = self.modelFolders.get(model, [])
+        if model in self.modelTextures:
+            for texture in self.modelTextures[model]:
+                for folder in folders:
+                    name = (folder + '/' + texture).strip('/')
+                    if name in self.materialFiles:
+                        if name not in materials:
+                            materials.append(name)
+                        break
+        else:
+            for folder in folders:
+                materials.extend(name for name in self.folderMaterials.get(folder, []) if name not in materials)
+        return materials
+
+    def groupMaterialFiles(self, fileNames):
+        # fileNames reordered so that the materials with the same main texture (usually the $basetexture) come one
+        # after the other, in the order each texture first shows up. Skins, team colours and LODs then get converted
+        # back to back, or by the same worker, and their textures are decoded once and come from the cache after that.
+        # Patches go with the material they include.
+        groups = {}
+        for fileName in fileNames:
+            name = self.getName(fileName)
+            seen = set()
+            while name in self.materialIncludes and name not in seen:
+                seen.add(name)
+                name = self.materialIncludes[name][0]
+            textures = self.materialTextures.get(name, [])
+            groups.setdefault(textures[0] if textures else fileName, []).append(fileName)
+        return [fileName for group in groups.values() for fileName in group]
+
+    def toDict(self):
+        return {
+            "materials": {name: {"file": self.materialFiles[name], "textures": self.getTextures(name),
+                                 "includes": self.materialIncludes.get(name, [])} for name in sorted(self.materialFiles)},
+            "textures": {texture: self.getMaterialsUsing(texture) for texture in sorted(self.textureUsers)},
+            "models": {name: {"files": self.modelFiles[name], "cdmaterials": self.modelFolders[name],
+                              "textures": self.modelTextures.get(name), "materials": self.getModelMaterials(name)}
+                       for name in sorted(self.modelFiles)},
+        }
+
+    def save(self, fileName):
+        dirName = os.path.dirname(os.path.abspath(fileName))
+        os.makedirs(dirName, exist_ok=True)
+        with open(fileName, 'w') as graphFile:
+            json.dump(self.toDict(), graphFile, indent=1, sort_keys=True)
+            graphFile.write('\n')
@@ -0,0 +1,318 @@
+# cmd command: python benchmark.py --materials 500 --texture-size 1024 --output before.json
+#
+# Benchmarks the converters on synthetic Source 1 content, so performance changes can be compared between versions.
+# Generates a materials folder of .vmts (with the usual mix of parameters) sharing a pool of .tga textures, and a
+# models folder of .mdls and .qcs, in a temporary folder. Then times every phase of vmt_to_vmat.py (walk, parse,
+# hash, texture read, texture write, .vmat write and everything else), and the walk and emit phases of mdl_to_vmdl.py and
+# qc_to_vmdl.py, and prints the results as JSON. Each phase reports the best of --repeat runs.
+
+import sys
+import os
+import json
+import time
+import shutil
+import random
+import struct
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import vmt_to_vmat
+import mdl_to_vmdl
+import qc_to_vmdl
+import assets
+import qc
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Kinds of texture in the shared pool, with the mode they're saved in
+textureKinds = {
+    "color": "RGBA",
+    "normal": "RGBA",
+    "exponent": "RGB",
+    "mask": "RGB",
+    "detail": "RGB",
+}
+
+###
+### Synthetic content
+###
+
+def makeTexture(fileName, size, mode):
+    # Noise, so nothing downstream gets an easy time from flat colours
+    os.makedirs(os.path.dirname(fileName), exist_ok=True)
+    image = Image.frombytes(mode, (size, size), os.urandom(size * size * len(mode)))
+    image.save(fileName)
+
+def makeMaterialTree(root, materialCount, textureCount, textureSize, seed):
+    # Returns the materials folder. Textures go where vmt_to_vmat.py will look for them.
+    rng = random.Random(seed)
+    modPath = os.path.join(root, "mod") + os.sep
+    materialsDir = os.path.join(modPath, "materials")
+    for kind, mode in textureKinds.items():
+        for i in range(textureCount):
+            texturePath = "models/bench/textures/" + kind + str(i)
+            makeTexture(vmt_to_vmat.findTexture(modPath, texturePath), textureSize, mode)
+
+    for i in range(materialCount):
+        folder = os.path.join(materialsDir, "models", "bench", "set" + str(i % 10))
+        os.makedirs(folder, exist_ok=True)
+        texture = str(rng.randrange(textureCount))
+        lines = ['"' + rng.choice(["VertexLitGeneric", "VertexLitGeneric", "LightmappedGeneric"]) + '"', '{']
+        lines.append('\t"$basetexture" "models/bench/textures/color' + texture + '"')
+        if rng.random() < 0.8:
+            lines.append('\t"$bumpmap" "models/bench/textures/normal' + texture + '"')
+        if rng.random() < 0.5:
+            lines.append('\t"$phong" "1"')
+            lines.append('\t"$phongboost" "' + str(rng.choice([1, 2, 4])) + '"')
+            if rng.random() < 0.5:
+                lines.append('\t"$phongexponenttexture" "models/bench/textures/exponent' + texture + '"')
+            else:
+                lines.append('\t"$basemapalphaphongmask" "1"')
+                lines.append('\t"$phongexponent" "' + str(rng.choice([5, 20, 60, 150])) + '"')
+        if rng.random() < 0.3:
+            lines.append('\t"$envmap" "env_cubemap"')
+            lines.append('\t"$envmapmask" "models/bench/textures/mask' + texture + '"')
+        if rng.random() < 0.15:
+            lines.append('\t"$selfillum" "1"')
+        if rng.random() < 0.2:
+            lines.append('\t"' + rng.choice(["$translucent", "$alphatest"]) + '" "1"')
+        if rng.random() < 0.25:
+            lines.append('\t"$color2" "[1 0.5 0.5]"')
+            lines.append('\t"$blendtintbybasealpha" "1"')
+        if rng.random() < 0.3:
+            lines.append('\t"$detail" "models/bench/textures/detail' + str(rng.randrange(textureCount)) + '"')
+            lines.append('\t"$detailscale" "4"')
+        lines.append('\t// comments and fallbacks are in real materials too')
+        lines.append('\t"' + lines[0].strip('"') + '_DX8"')
+        lines.append('\t{')
+        lines.append('\t\t"$basetexture" "models/bench/textures/color0"')
+        lines.append('\t}')
+        lines.append('}')
+        with open(os.path.join(folder, "material" + str(i) + ".vmt"), 'w') as vmtFile:
+            vmtFile.write('\n'.join(lines) + '\n')
+    return materialsDir
+
+def makeMdl(fileName, modelName, textures, cdTextures):
+    # Just the header and the texture tables, which is all mdl.py reads. No body parts, so no .vvd or .vtx is needed.
+    tableOffset = 408
+    stringOffset = tableOffset + 64 * len(textures) + 4 * len(cdTextures)
+    tables = bytearray()
+    strings = bytearray()
+    for i, texture in enumerate(textures):
+        tables += struct.pack('<i60x', stringOffset + len(strings) - tableOffset - 64 * i)
+        strings += texture.encode() + b'\0'
+    for cdTexture in cdTextures:
+        tables += struct.pack('<i', stringOffset + len(strings))
+        strings += cdTexture.encode() + b'\0'
+    header = bytearray(408)
+    length = len(header) + len(tables) + len(strings)
+    struct.pack_into('<4s2i64si', header, 0, b'IDST', 48, 0, modelName.encode(), length)
+    struct.pack_into('<4i', header, 204, len(textures), tableOffset, len(cdTextures), tableOffset + 64 * len(textures))
+    with open(fileName, 'wb') as mdlFile:
+        mdlFile.write(header + tables + strings)
+
+def makeModelTree(root, modelCount, seed):
+    # Returns the models folder, with an .mdl and a .qc for every model
+    rng = random.Random(seed)
+    modelsDir = os.path.join(root, "content", "models")
+    for i in range(modelCount):
+        folder = os.path.join(modelsDir, "bench", "set" + str(i % 10))
+        os.makedirs(folder, exist_ok=True)
+        name = "model" + str(i)
+        makeMdl(os.path.join(folder, name + ".mdl"), "bench/set" + str(i % 10) + "/" + name + ".mdl",
+                ["material" + str(i), "material" + str(rng.randrange(modelCount))], ["models/bench/set" + str(i % 10) + "/"])
+        lines = ['$modelname "bench/set' + str(i % 10) + '/' + name + '.mdl"',
+                 '$cdmaterials "models/bench/set' + str(i % 10) + '"',
+                 '$body "body" "' + name + '_ref.smd"']
+        for j in range(rng.randrange(3)):
+            lines.append('$bodygroup "group' + str(j) + '" { studio "' + name + '_group' + str(j) + '.smd" blank }')
+        lines.append('$sequence "idle" "' + name + '_idle.smd" // comment')
+        with open(os.path.join(folder, name + ".qc"), 'w') as qcFile:
+            qcFile.write('\n'.join(lines) + '\n')
+    return modelsDir
+
+###
+### Timing
+###
+
+class PhaseTimer:
+    # Adds up the time spent in functions wrapped with wrap(). Only the outermost call of a phase counts, so recursive
+    # or nested calls (i.e. patch materials resolving the material they include) aren't counted twice.
+    def __init__(self):
+        self.times = {}
+        self.depth = {}
+        self.restore = []
+
+    def wrap(self, owner, name, phase):
+        original = getattr(owner, name)
+        timer = self
+        self.times.setdefault(phase, 0.0)
+        self.depth.setdefault(phase, 0)
+
+        def timed(*args, **kwargs):
+            if timer.depth[phase]:
+                return original(*args, **kwargs)
+            timer.depth[phase] += 1
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                timer.times[phase] += time.perf_counter() - start
+                timer.depth[phase] -= 1
+
+        setattr(owner, name, timed)
+        self.restore.append((owner, name, original))
+
+    def unwrap(self):
+        for owner, name, original in reversed(self.restore):
+            setattr(owner, name, original)
+        self.restore = []
+
+def benchmarkVmtToVmat(materialsDir):
+    # One serial run over the whole tree, starting from an empty _imported folder and empty caches
+    shutil.rmtree(vmt_to_vmat.addFolderExtension(materialsDir).split('materials')[0], ignore_errors=True)
+    vmt_to_vmat.textureCache = None
+    vmt_to_vmat.materialStore = None
+    vmt_to_vmat.fileHashes = {}
+    settings = vmt_to_vmat.ConverterSettings(overwriteVmat=True, overwriteTga=True, pbrHack=True)
+
+    timer = PhaseTimer()
+    timer.wrap(vmt_to_vmat.MaterialStore, "resolve", "parse")
+    timer.wrap(vmt_to_vmat, "fileSignature", "hash")
+    timer.wrap(vmt_to_vmat.TextureCache, "open", "texture_read")
+    timer.wrap(vmt_to_vmat.TextureCache, "decode", "texture_read")
+    timer.wrap(vmt_to_vmat, "saveTexture", "texture_write")
+    timer.wrap(vmt_to_vmat, "copyOnce", "texture_write")
+    try:
+        start = time.perf_counter()
+        fileList = vmt_to_vmat.parseDir(materialsDir)
+        walkTime = time.perf_counter() - start
+
+        settings.runStartTime = time.time()
+        vmatWriteTime = 0.0
+        start = time.perf_counter()
+        for vmtFileName in fileList:
+            result = vmt_to_vmat.convertMaterial(vmtFileName, settings)
+            if result.status != "converted":
+                raise RuntimeError("benchmark material failed to convert:\n" + '\n'.join(result.logLines))
+            # versions that time their own phases (see vmt_to_vmat.timed()) know how long writing the .vmat took,
+            # not counting the maps written and built while it's open
+            if hasattr(result, "phases"):
+                vmatWriteTime += result.phases.get("vmat_write", [0.0])[0]
+        convertTime = time.perf_counter() - start
+    finally:
+        timer.unwrap()
+
+    phases = {"walk": walkTime}
+    phases.update(timer.times)
+    if hasattr(vmt_to_vmat, "timed"):
+        phases["vmat_write"] = vmatWriteTime
+    # whatever's left isn't timed on its own: building maps, looking at alpha channels...
+    phases["other"] = convertTime - sum(timer.times.values()) - vmatWriteTime
+    phases["total"] = walkTime + convertTime
+    return len(fileList), phases
+
+def removeOutputs(modelsDir):
+    for root, dirs, fileNames in os.walk(modelsDir):
+        for fileName in fileNames:
+            if fileName.endswith('.vmdl'):
+                os.remove(os.path.join(root, fileName))
+
+def benchmarkModelScript(modelsDir, walk, emit):
+    # Times walking the folder for the model sources and writing the .vmdls for all of them. Every run starts cold,
+    # without the asset index the last one wrote or the .qc includes it read.
+    removeOutputs(modelsDir)
+    indexFileName = assets.getIndexFileName(modelsDir)
+    if os.path.exists(indexFileName):
+        os.remove(indexFileName)
+    qc.sharedReader = None
+    start = time.perf_counter()
+    files = walk(modelsDir)
+    walkTime = time.perf_counter() - start
+    start = time.perf_counter()
+    emit(files)
+    emitTime = time.perf_counter() - start
+    return {"walk": walkTime, "emit": emitTime, "total": walkTime + emitTime}
+
+def benchmarkMdlToVmdl(modelsDir):
+    return benchmarkModelScript(modelsDir, mdl_to_vmdl.walk_dir, mdl_to_vmdl.convert_models)
+
+def benchmarkQcToVmdl(modelsDir):
+    return benchmarkModelScript(modelsDir, qc_to_vmdl.walk_dir,
+                                lambda files: [qc_to_vmdl.convert_qc(fileName, modelsDir) for fileName in files])
+
+def bestOf(runs):
+    return {phase: min(run[phase] for run in runs) for phase in runs[0]}
+
+def getVersion():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=SCRIPT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+###
+### Main Execution
+###
+
+def main():
+    argParser = argparse.ArgumentParser(description='Times the converters on synthetic Source 1 content and prints the results as JSON.')
+    argParser.add_argument('--materials', type=int, default=200, help='number of .vmts to generate')
+    argParser.add_argument('--textures', type=int, default=16, help='number of textures of each kind the .vmts share')
+    argParser.add_argument('--texture-size', type=int, default=512, metavar='PIXELS', help='width and height of the textures')
+    argParser.add_argument('--models', type=int, default=200, help='number of .mdls and .qcs to generate')
+    argParser.add_argument('--repeat', type=int, default=3, help='runs of each converter, the best one is reported')
+    argParser.add_argument('--seed', type=int, default=0, help='seed for the random material and model mix')
+    argParser.add_argument('--workdir', help='generate the content here instead of in a temporary folder (kept afterwards)')
+    argParser.add_argument('--output', help='also write the results to this file')
+    args = argParser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix='exsrc2utils_bench_')
+    try:
+        start = time.perf_counter()
+        materialsDir = makeMaterialTree(root, args.materials, args.textures, args.texture_size, args.seed)
+        modelsDir = makeModelTree(root, args.models, args.seed)
+        generateTime = time.perf_counter() - start
+
+        results = {}
+        runs = []
+        for i in range(args.repeat):
+            fileCount, phases = benchmarkVmtToVmat(materialsDir)
+            runs.append(phases)
+        results["vmt_to_vmat"] = {"files": fileCount, "best": bestOf(runs), "runs": runs}
+
+        for scriptName, benchmark in (("mdl_to_vmdl", benchmarkMdlToVmdl), ("qc_to_vmdl", benchmarkQcToVmdl)):
+            runs = [benchmark(modelsDir) for i in range(args.repeat)]
+            results[scriptName] = {"files": args.models, "best": bestOf(runs), "runs": runs}
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "version": getVersion(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "materials": args.materials,
+            "textures": args.textures,
+            "texture_size": args.texture_size,
+            "models": args.models,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "generate_seconds": generateTime,
+        "results": results,
+    }
+    reportText = json.dumps(report, indent=2)
+    print(reportText)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(reportText + '\n')
+
+if __name__ == '__main__':
+    main()
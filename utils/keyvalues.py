@@ -0,0 +1,81 @@
+# Tokenizer and parser for Valve's KeyValues text format (.vmt, .vmf, gameinfo.txt...)
+#
+# Everything is done in one regex pass over each line, so a file is never scanned more than once and never has to be
+# held in memory as a whole (pass an open file object as lines). Handles quoted and unquoted strings, // comments,
+# nested { } blocks, [ ] and { } vectors written without quotes, and [$WIN32] style conditionals (which are dropped).
+
+import re
+
+# Token kinds
+STRING = 0
+OPEN = 1
+CLOSE = 2
+
+# The order matters: quoted strings first so "//" and braces inside them are left alone, then unquoted vectors
+# (i.e. $color {255 255 255} or $color [1 1 1]) before a lone { is taken as the start of a block.
+tokenPattern = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<comment>//.*)
+  | "(?P<quoted>[^"\n]*)"?
+  | (?P<vector>\{[ \t\d.\-]*\}|\[[^\]\n]*\])
+  | (?P<open>\{)
+  | (?P<close>\})
+  | (?P<word>(?:[^\s"{}/]|/(?!/))+)
+''', re.VERBOSE)
+
+def tokenize(lines):
+    # Yields (kind, text, quoted) for every token in lines, which can be any iterable of strings
+    for line in lines:
+        for match in tokenPattern.finditer(line):
+            group = match.lastgroup
+            if group == 'quoted':
+                yield STRING, match.group('quoted'), True
+            elif group == 'word' or group == 'vector':
+                yield STRING, match.group(group), False
+            elif group == 'open':
+                yield OPEN, '{', False
+            elif group == 'close':
+                yield CLOSE, '}', False
+
+def isConditional(text, quoted):
+    return not quoted and text.startswith('[') and '$' in text
+
+def parseKeyValues(lines):
+    # Returns the file as a list of (key, value) pairs, where value is either a string or another list of pairs
+    # for a { } block. Pairs are kept in order and duplicate keys are kept, it's up to the caller what to do with them.
+    # Broken files are read as far as possible: stray closing braces are ignored and unclosed blocks end with the file.
+    root = []
+    stack = [root]
+    key = None
+    for kind, text, quoted in tokenize(lines):
+        if kind == STRING:
+            if key is None:
+                if not isConditional(text, quoted):
+                    key = text
+            else:
+                stack[-1].append((key, text))
+                key = None
+        elif kind == OPEN:
+            block = []
+            stack[-1].append((key if key is not None else '', block))
+            stack.append(block)
+            key = None
+        else:
+            if len(stack) > 1:
+                stack.pop()
+            key = None
+    return root
+
+def keyValuesToDict(pairs, lower = False):
+    # Turns parseKeyValues() pairs into nested dicts. Like the engine, the first of any duplicate keys wins.
+    result = {}
+    for key, value in pairs:
+        if lower:
+            key = key.lower()
+        if key in result:
+            continue
+        if isinstance(value, list):
+            result[key] = keyValuesToDict(value, lower)
+        else:
+            result[key] = value.lower() if lower else value
+    return result
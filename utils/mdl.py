@@ -0,0 +1,116 @@
+# Reads the header of compiled Source 1 models (.mdl, studiohdr_t), for what a model needs rather than what it looks
+# like: its name, the materials it uses (the texture table, the cdtexture table of folders to look for them in and
+# the skin table of which ones each skin uses) and its body parts.
+#
+# The file is mapped instead of read, and only the fixed size header and those tables are ever touched, so opening a
+# model costs about the same no matter how big it is. Works with the .mdls of every Source 1 branch from version 44
+# (HL2) up, they all start the same way.
+
+import os
+import mmap
+import struct
+
+MDL_SIGNATURE = b'IDST'
+MDL_MIN_VERSION = 44
+
+# Size of studiohdr_t, the part every version shares
+HEADER_SIZE = 408
+# mstudiotexture_t, of which only sznameindex (relative to the start of the entry) matters here
+TEXTURE_SIZE = 64
+# mstudiobodyparts_t: sznameindex, nummodels, base, modelindex (both indexes relative to the start of the entry)
+BODYPART_SIZE = 16
+# mstudiomodel_t: name[64], type, boundingradius, nummeshes, meshindex, numvertices...
+MODEL_SIZE = 148
+MODEL_VERTEXCOUNT_OFFSET = 80
+
+# Companion files the vertex data is in, which models with any vertices can't be imported without
+VVD_EXTENSION = '.vvd'
+VTX_EXTENSIONS = ['.dx90.vtx', '.dx80.vtx', '.sw.vtx', '.vtx']
+
+class MDLError(Exception):
+    pass
+
+class MDLFile:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as f:
+            self.fileSize = os.fstat(f.fileno()).st_size
+            if self.fileSize < HEADER_SIZE:
+                raise MDLError(fileName + " is not a Source model")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.read(data)
+
+    def read(self, data):
+        if data[:4] != MDL_SIGNATURE:
+            raise MDLError(self.fileName + " is not a Source model")
+        self.version, self.checksum, name, self.length = struct.unpack_from('<2i64si', data, 4)
+        self.name = name.split(b'\0', 1)[0].decode('ascii', 'replace')
+        if self.version < MDL_MIN_VERSION:
+            raise MDLError(self.fileName + " is a version " + str(self.version) + " model, which isn't supported")
+        self.flags, = struct.unpack_from('<i', data, 152)
+        (textureCount, textureOffset, cdTextureCount, cdTextureOffset, skinRefCount, skinFamilyCount, skinOffset,
+         bodyPartCount, bodyPartOffset) = struct.unpack_from('<9i', data, 204)
+
+        self.textures = []
+        for offset in self.getTable(data, textureOffset, textureCount, TEXTURE_SIZE):
+            self.textures.append(self.readString(data, offset + struct.unpack_from('<i', data, offset)[0]))
+
+        self.cdTextures = []
+        for offset in self.getTable(data, cdTextureOffset, cdTextureCount, 4):
+            self.cdTextures.append(self.readString(data, struct.unpack_from('<i', data, offset)[0]))
+
+        # skins[family][skinref] is the index of the texture that skin uses in place of the first one
+        self.skins = []
+        for offset in self.getTable(data, skinOffset, skinFamilyCount, skinRefCount * 2):
+            self.skins.append(list(struct.unpack_from('<' + str(skinRefCount) + 'h', data, offset)))
+
+        # [(name, [(model name, vertex count)])]
+        self.bodyParts = []
+        for offset in self.getTable(data, bodyPartOffset, bodyPartCount, BODYPART_SIZE):
+            nameOffset, modelCount, base, modelOffset = struct.unpack_from('<4i', data, offset)
+            models = []
+            for model in self.getTable(data, offset + modelOffset, modelCount, MODEL_SIZE):
+                modelName = data[model:model + 64].split(b'\0', 1)[0].decode('ascii', 'replace')
+                models.append((modelName, struct.unpack_from('<i', data, model + MODEL_VERTEXCOUNT_OFFSET)[0]))
+            self.bodyParts.append((self.readString(data, offset + nameOffset), models))
+
+    def getTable(self, data, offset, count, entrySize):
+        # Offsets of the entries of a table, after checking all of it is in the file
+        if count < 0 or (count and (offset < 0 or offset + count * entrySize > len(data))):
+            raise MDLError(self.fileName + " is truncated or corrupt")
+        return range(offset, offset + count * entrySize, max(1, entrySize))
+
+    def readString(self, data, offset):
+        # Strings are stored null terminated, somewhere after the tables
+        end = data.find(b'\0', offset) if 0 <= offset < len(data) else -1
+        if end < 0:
+            raise MDLError(self.fileName + " is truncated or corrupt")
+        return data[offset:end].decode('ascii', 'replace')
+
+    def getUsedTextures(self):
+        # The textures some skin uses, in the order of the texture table. All of them if the model has no skin table.
+        if not self.skins:
+            return list(self.textures)
+        used = set(index for skin in self.skins for index in skin)
+        return [texture for index, texture in enumerate(self.textures) if index in used]
+
+    def getVertexCount(self):
+        return sum(vertexCount for name, models in self.bodyParts for modelName, vertexCount in models)
+
+    def validate(self):
+        # Raises MDLError for the things that would make the model fail to compile in Source 2, which the header
+        # alone can tell: a file of the wrong length (cut off while copying), skins using textures that aren't there
+        # and missing vertex data files.
+        problems = []
+        if self.length != self.fileSize:
+            problems.append("its header says it's " + str(self.length) + " bytes, but the file is " + str(self.fileSize))
+        if any(index < 0 or index >= len(self.textures) for skin in self.skins for index in skin):
+            problems.append("a skin uses a material that isn't in it")
+        if self.getVertexCount() > 0:
+            baseName = os.path.splitext(self.fileName)[0]
+            if not os.path.exists(baseName + VVD_EXTENSION):
+                problems.append("its " + VVD_EXTENSION + " file is missing")
+            if not any(os.path.exists(baseName + extension) for extension in VTX_EXTENSIONS):
+                problems.append("its .vtx file is missing")
+        if problems:
+            raise MDLError(self.fileName + " is broken: " + ", ".join(problems))
@@ -1,15 +1,26 @@
 # cmd command: python mdl_to_vmdl.py "C:\Program Files (x86)\Steam\steamapps\common\SteamVR\tools\steamvr_environments\content\steamtours_addons\l4d2_converted\models"
 # MUST run in the models folder
+# Asks for the folder if it isn't given. Other scripts can import this and call convert_models() (or convert_model() for
+# each .mdl) instead.
 
-import re, sys, os
+import re, sys, os, argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import assets
+import mdl
 
 INPUT_FILE_EXT = '.mdl'
 OUTPUT_FILE_EXT = '.vmdl'
+# Threads writing .vmdls at once. Writing them is mostly waiting for the file system, which takes a while on a
+# network share, so this can be well above the number of CPU cores.
+WRITE_THREADS = 8
+# Same as in vmt_to_vmat.py, the materials of models in an _imported folder can still be .vmts in the original one
+TARGET_FOLDER_EXTENSION = '_imported'
     
 VMDL_BASE = '''<!-- kv3 encoding:text:version{e21c7f3c-8a33-41c5-9977-a76d3a32aa0d} format:generic:version{7412167c-06e9-4698-aff2-e63eb59037e7} -->
 {
     m_sMDLFilename = "<mdl>"
-}
+<materials>}
 '''
 
 def text_parser(filepath, separator="="):
@@ -22,19 +33,34 @@ def text_parser(filepath, separator="="):
                 return_dict[line[0]] = line[1]
     return return_dict
 
-def walk_dir(dirname):
-    files = []
-
-    for root, dirs, filenames in os.walk(dirname):
-        for filename in filenames:
-            if filename.lower().endswith(INPUT_FILE_EXT):
-                files.append(os.path.join(root,filename))
-            
-    return files
+def walk_dir(dirname, inventory = None, rescan = False):
+    # inventory is an AssetInventory (see assets.py) to take the files from, when the folder was already walked.
+    # Otherwise the asset index in the _imported folder is used, rescan lists every folder again.
+    if inventory is None:
+        inventory = assets.loadInventory(dirname, rescan=rescan)
+    return inventory.getFiles("model", dirname)
 
 def putl(f, line, indent = 0):
     f.write(('\t' * indent) + line + '\r\n')
 
+def write_vmdl(out_name, text):
+    # Writes text to out_name unless it already has exactly that in it, so the asset browser doesn't see a change
+    # (and recompile the model) when nothing changed. Goes through a temporary file, so a .vmdl is never half written.
+    # Returns whether the file was written.
+    data = text.replace('\n', os.linesep).encode('utf-8')
+    try:
+        if os.path.getsize(out_name) == len(data):
+            with open(out_name, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except OSError:
+        pass
+    tmp_name = out_name + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_name, 'wb') as out:
+        out.write(data)
+    os.replace(tmp_name, out_name)
+    return True
+
 def strip_quotes(s):
     return s.strip('"').strip("'")
 
@@ -51,40 +77,134 @@ def relative_path(s, base):
 def get_mesh_name(file):
     return os.path.splitext(os.path.basename(fix_path(file)))[0]
 
-print('--------------------------------------------------------------------------------------------------------')
-print('Source 2 VMDL Generator! By Rectus via Github.')
-print('Initially forked by Alpyne, this version by caseytube.')
-print('--------------------------------------------------------------------------------------------------------')
-print('Reminder to put your models in the same directory structure as Source 1, starting with models!\n')
-abspath = ''
-files = []
-
-PATH_TO_CONTENT_ROOT = input("What folder would you like to convert? Valid Format: C:\\Steam\\steamapps\\Half-Life Alyx\\content\\tf\\models\\props_spytech\\: ").lower()
-if not os.path.exists(PATH_TO_CONTENT_ROOT):
-    print("Please respond with a valid folder or file path! Quitting Process!")
-    quit()
-
-# recursively search all dirs and files
-abspath = os.path.abspath(PATH_TO_CONTENT_ROOT)
-print(abspath)
-if os.path.isdir(abspath):
-    files.extend(walk_dir(abspath))
-#else:
-#    if abspath.lower().endswith(INPUT_FILE_EXT):
-#        files.append(abspath)
-
-for filename in files:
+def get_materials(filename, model = None):
+    # The $cdmaterials folders and the names of the materials a compiled .mdl uses, as
+    # {"cdmaterials": [...], "textures": [...]} named like assets.DependencyGraph names them.
+    # model is the mdl.MDLFile of it, if it's already open.
+    model = model or mdl.MDLFile(filename)
+    return {
+        "cdmaterials": [assets.normalizePath(folder) for folder in model.cdTextures],
+        "textures": [re.sub(r'\.vmt$', '', assets.normalizePath(texture)) for texture in model.getUsedTextures()],
+    }
+
+def find_materials(filename, materials):
+    # The .vmat every material in get_materials() ends up as (relative to the content folder), from the first
+    # $cdmaterials folder that has it like the engine does, and whether it was found at all
+    mod_path = assets.splitModPath(filename)
+    if mod_path is None:
+        return [('materials/' + texture + '.vmat', False) for texture in materials["textures"]]
+    mod_folders = [mod_path[0]]
+    if mod_path[0].lower().endswith(TARGET_FOLDER_EXTENSION):
+        mod_folders.append(mod_path[0][:-len(TARGET_FOLDER_EXTENSION)])
+    else:
+        mod_folders.append(mod_path[0] + TARGET_FOLDER_EXTENSION)
+
+    found = []
+    for texture in materials["textures"]:
+        names = [(folder + '/' + texture).strip('/') for folder in materials["cdmaterials"]] or [texture]
+        for name in names:
+            material_file = os.path.join('materials', *name.split('/'))
+            if any(os.path.exists(os.path.join(mod_folder, material_file + extension))
+                   for mod_folder in mod_folders for extension in ('.vmat', '.vmt')):
+                found.append(('materials/' + name + '.vmat', True))
+                break
+        else:
+            found.append(('materials/' + names[0] + '.vmat', False))
+    return found
+
+def convert_model(filename):
+    # Writes the .vmdl for one .mdl next to it and returns its file name, or None if it was already up to date.
+    # The .mdl's header is checked first, models that would only fail in the resource compiler raise an mdl.MDLError
+    # instead, and nothing is written for them.
     out_name = filename.replace(INPUT_FILE_EXT, OUTPUT_FILE_EXT)
-    #if os.path.exists(out_name): continue
 
-    print('Importing', os.path.basename(filename))
+    model = mdl.MDLFile(filename)
+    model.validate()
+
+    # where the .mdl is in the content folder, or failing that where it was compiled to
+    mod_path = assets.splitModPath(filename)
+    if mod_path is not None and mod_path[1] == 'models':
+        mdl_path = 'models/' + mod_path[2]
+    else:
+        mdl_path = fix_path('models/' + model.name)
+
+    # the materials it uses, as a comment for whoever has to track down a missing one
+    materials = ''
+    for material, found in find_materials(filename, get_materials(filename, model)):
+        materials += '    // ' + material + ('' if found else ' (not found)') + '\n'
+    if materials:
+        materials = '    // Materials:\n' + materials
+
+    vmdl = VMDL_BASE.replace('<mdl>', mdl_path).replace('<materials>', materials).replace((' ' * 4), '\t')
+    if not write_vmdl(out_name, vmdl + '\r\n'):
+        return None
+    return out_name
+
+def convert_models(files, jobs = WRITE_THREADS, log = print):
+    # convert_model() for every .mdl in files, jobs at a time. Errors are logged in the order of files, and the
+    # number of .vmdls written, already up to date and skipped for being broken is returned.
+    def convert(filename):
+        try:
+            return convert_model(filename), None
+        except (OSError, mdl.MDLError) as error:
+            return None, error
+
+    counts = {"written": 0, "unchanged": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for out_name, error in executor.map(convert, files):
+            if error is not None:
+                log('- ERROR: ' + str(error) + '. Skipping!')
+                counts["failed"] += 1
+            elif out_name is None:
+                counts["unchanged"] += 1
+            else:
+                counts["written"] += 1
+    return counts
 
-    out = sys.stdout
+abspath = ''
 
-    sourcePath = "models" + filename.split("models", 1)[1] # HACK?
-    mdl_path = fix_path(sourcePath)
-    
-    with open(out_name, 'w') as out:
-        putl(out, VMDL_BASE.replace('<mdl>', mdl_path).replace((' ' * 4), '\t'))
+def main():
+    global abspath
+
+    print('--------------------------------------------------------------------------------------------------------')
+    print('Source 2 VMDL Generator! By Rectus via Github.')
+    print('Initially forked by Alpyne, this version by caseytube.')
+    print('--------------------------------------------------------------------------------------------------------')
+    print('Reminder to put your models in the same directory structure as Source 1, starting with models!\n')
+    arg_parser = argparse.ArgumentParser(description='Generates .vmdl files that import .mdl files into Source 2. '
+                                         'Asks for the folder if none is given.')
+    arg_parser.add_argument('path', nargs='?', help='models folder to convert. Nothing is asked for when this is given')
+    arg_parser.add_argument('--rescan', action='store_true', help='ignore the asset index and look in every folder again')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=WRITE_THREADS, help='number of .vmdls to write at once')
+    args = arg_parser.parse_args()
+    interactive = args.path is None
+    files = []
 
-input("Press the <ENTER> key to close...")
\ No newline at end of file
+    if interactive:
+        PATH_TO_CONTENT_ROOT = input("What folder would you like to convert? Valid Format: C:\\Steam\\steamapps\\Half-Life Alyx\\content\\tf\\models\\props_spytech\\: ").lower()
+    else:
+        PATH_TO_CONTENT_ROOT = args.path
+    if not os.path.exists(PATH_TO_CONTENT_ROOT):
+        print("Please respond with a valid folder or file path! Quitting Process!")
+        if not interactive:
+            sys.exit(2)
+        quit()
+
+    # recursively search all dirs and files
+    abspath = os.path.abspath(PATH_TO_CONTENT_ROOT)
+    print(abspath)
+    if os.path.isdir(abspath):
+        files.extend(walk_dir(abspath, rescan=args.rescan))
+    #else:
+    #    if abspath.lower().endswith(INPUT_FILE_EXT):
+    #        files.append(abspath)
+
+    counts = convert_models(files, args.jobs)
+    print('+ Wrote ' + str(counts["written"]) + ' .vmdl files, ' + str(counts["unchanged"]) + ' were already up to date'
+          + (' and ' + str(counts["failed"]) + ' models are broken.' if counts["failed"] else '.'))
+
+    if interactive:
+        input("Press the <ENTER> key to close...")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# Tokenizer and parser for studiomdl's .qc model scripts (and the .qci files they $include)
+#
+# Reads a .qc into a list of (command, arguments) in the order studiomdl would run them, with $include files put in
+# place, $definevariable variables filled in and $definemacro macros expanded where $macro uses them. Arguments are
+# strings, and { } blocks are nested lists of the strings (and blocks) in them. Handles quoted strings, // and /* */
+# comments, and commands split over several lines or sharing one.
+#
+# Includes are only read and tokenized once per QCReader, so a run over hundreds of .qcs sharing the same .qcis
+# (TF2's player models, for example) reads each of those once.
+
+import os
+import re
+
+# Token kinds
+STRING = 0
+OPEN = 1
+CLOSE = 2
+NEWLINE = 3
+
+tokenPattern = re.compile(r'''
+    (?P<newline>\n)
+  | (?P<space>[^\S\n]+)
+  | (?P<comment>//[^\n]*)
+  | (?P<blockcomment>/\*[\s\S]*?(?:\*/|\Z))
+  | "(?P<quoted>[^"\n]*)"?
+  | (?P<open>\{)
+  | (?P<close>\})
+  | (?P<word>(?:[^\s"{}/]|/(?![/*]))+)
+''', re.VERBOSE)
+
+variablePattern = re.compile(r'\$(\w+)\$')
+
+# How deep includes and macros can go in each other before it's taken as a loop
+MAX_DEPTH = 16
+
+def tokenize(text):
+    # Returns a list of (kind, text, quoted) for every token in text. Newlines are tokens too, $definemacro needs them.
+    tokens = []
+    for match in tokenPattern.finditer(text):
+        group = match.lastgroup
+        if group == 'quoted':
+            tokens.append((STRING, match.group('quoted'), True))
+        elif group == 'word':
+            tokens.append((STRING, match.group('word'), False))
+        elif group == 'open':
+            tokens.append((OPEN, '{', False))
+        elif group == 'close':
+            tokens.append((CLOSE, '}', False))
+        elif group == 'newline' or (group == 'blockcomment' and '\n' in match.group()):
+            tokens.append((NEWLINE, '\n', False))
+    return tokens
+
+def isCommand(token):
+    return token[0] == STRING and not token[2] and token[1].startswith('$') and len(token[1]) > 1
+
+class QCError(Exception):
+    pass
+
+class QCReader:
+    # Parses .qcs, keeping the tokens of every include it reads (by path and modified time) for the next .qc that
+    # includes it too
+    def __init__(self):
+        self.files = {}
+        self.hits = 0
+        self.misses = 0
+
+    def getTokens(self, fileName, keep = True):
+        key = os.path.normcase(os.path.abspath(fileName))
+        mtime = os.stat(fileName).st_mtime_ns
+        cached = self.files.get(key)
+        if cached is not None and cached[0] == mtime:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        with open(fileName, 'r', errors='replace') as qcFile:
+            tokens = tokenize(qcFile.read())
+        if keep:
+            self.files[key] = (mtime, tokens)
+        return tokens
+
+    def findInclude(self, path, fileNames):
+        # Relative to the .qc being read like studiomdl does, or to the file the $include is in
+        for fileName in fileNames:
+            includeFileName = os.path.join(os.path.dirname(fileName), *re.split(r'[\\/]+', path))
+            if os.path.exists(includeFileName):
+                return includeFileName
+        return None
+
+    def read(self, fileName):
+        # Returns the commands of a .qc as [(command, arguments)], command in lowercase with its $.
+        # Includes that can't be found and macros that were never defined are left in as $include and $macro
+        # commands, for the caller to report.
+        commands = []
+        variables = {}
+        macros = {}     # name: (argument names, tokens, file it's defined in)
+        # Tokens still to go, as a stack of [tokens, position, file they're from], so includes and macros are read
+        # in place without copying everything after them
+        stack = [[self.getTokens(fileName, False), 0, fileName]]
+
+        def fillVariable(match):
+            return variables.get(match.group(1).lower(), match.group())
+
+        def nextToken():
+            while stack:
+                current = stack[-1]
+                if current[1] < len(current[0]):
+                    token = current[0][current[1]]
+                    current[1] += 1
+                    if token[0] == STRING and '$' in token[1]:
+                        token = (STRING, variablePattern.sub(fillVariable, token[1]), token[2])
+                    return token
+                stack.pop()
+            return None
+
+        def readLineTokens():
+            # The tokens up to the end of the line, or of the file the line is in
+            line = []
+            current = stack[-1]
+            while current[1] < len(current[0]):
+                token = nextToken()
+                if token[0] == NEWLINE:
+                    break
+                line.append(token)
+            return line
+
+        def readLine():
+            # The strings up to the end of the line
+            return [token[1] for token in readLineTokens() if token[0] == STRING]
+
+        def readBlock():
+            block = []
+            token = nextToken()
+            while token is not None and token[0] != CLOSE:
+                if token[0] == STRING:
+                    block.append(token[1])
+                elif token[0] == OPEN:
+                    block.append(readBlock())
+                token = nextToken()
+            return block
+
+        def push(tokens, source):
+            if len(stack) > MAX_DEPTH:
+                raise QCError(fileName + " includes or expands too deep, there's probably a loop")
+            stack.append([tokens, 0, source])
+
+        token = nextToken()
+        while token is not None:
+            if not isCommand(token):
+                # text or braces that don't belong to a command, studiomdl would complain about these
+                if token[0] == OPEN:
+                    readBlock()
+                token = nextToken()
+                continue
+
+            command = token[1].lower()
+            source = stack[-1][2]
+            if command == '$definevariable':
+                line = readLine()
+                if len(line) >= 2:
+                    variables[line[0].lower()] = line[1]
+            elif command == '$definemacro':
+                # $definemacro name argument... \ and then the lines of the macro, for as long as they end in \
+                line = readLine()
+                body = []
+                continued = bool(line) and line[-1] == '\\'
+                while continued:
+                    bodyLine = readLineTokens()
+                    continued = bool(bodyLine) and bodyLine[-1][1] == '\\' and not bodyLine[-1][2]
+                    body.extend(bodyLine[:-1] if continued else bodyLine)
+                    body.append((NEWLINE, '\n', False))
+                line = [name for name in line if name != '\\']
+                if line:
+                    macros[line[0].lower()] = ([name.lower() for name in line[1:]], body, source)
+            elif command == '$macro':
+                line = readLine()
+                if line and line[0].lower() in macros:
+                    argumentNames, body, macroSource = macros[line[0].lower()]
+                    values = dict(zip(argumentNames, line[1:]))
+                    fillArgument = lambda match: values.get(match.group(1).lower(), match.group())
+                    push([(STRING, variablePattern.sub(fillArgument, text), quoted) if kind == STRING else (kind, text, quoted)
+                          for kind, text, quoted in body], macroSource)
+                else:
+                    commands.append((command, line))
+            elif command == '$include':
+                line = readLine()
+                includeFileName = self.findInclude(line[0], [fileName, source]) if line else None
+                if includeFileName is not None:
+                    push(self.getTokens(includeFileName), includeFileName)
+                else:
+                    commands.append((command, line))
+            else:
+                arguments = []
+                token = nextToken()
+                while token is not None and not isCommand(token):
+                    if token[0] == STRING:
+                        arguments.append(token[1])
+                    elif token[0] == OPEN:
+                        arguments.append(readBlock())
+                    token = nextToken()
+                commands.append((command, arguments))
+                continue
+            token = nextToken()
+        return commands
+
+# One per process, so everything reading .qcs (the asset index, qc_to_vmdl.py...) shares the includes it has read
+sharedReader = None
+
+def getReader():
+    global sharedReader
+    if sharedReader is None:
+        sharedReader = QCReader()
+    return sharedReader
@@ -1,4 +1,10 @@
-import re, sys, os
+# cmd command: python qc_to_vmdl.py "C:\path\to\models"
+# Other scripts can import this and call convert_qc() for each .qc instead.
+
+import re, sys, os, argparse
+
+import assets
+import qc
 
 INPUT_FILE_EXT = '.qc'
 OUTPUT_FILE_EXT = '.vmdl'
@@ -14,9 +20,17 @@ VMDL_BASE = '''<!-- kv3 encoding:text:version{e21c7f3c-8a33-41c5-9977-a76d3a32aa
             <meshes>
         ]
     }
-    
+    <lists>
 }
 '''
+VMDL_LIST = '''<name> =
+    {
+        <name> =
+        [
+            <items>
+        ]
+    }
+    '''
 VMDL_MESH = '''{{
     m_meshName = "{mesh_name}"
     m_meshFile = "{mesh_file}"
@@ -33,35 +47,29 @@ VMDL_MESH = '''{{
 }},
 '''.replace('\n', '\n\t\t\t')
 
-def parse_qc(qc):
-    # strip comments
-    qc = re.sub(r'//.*', '', qc)
-    tokens = re.split(r'\s+', qc)
-
-    return tokens
-
-def walk_dir(dirname):
-    files = []
-
-    for root, dirs, filenames in os.walk(dirname):
-        for filename in filenames:
-            if filename.lower().endswith(INPUT_FILE_EXT):
-                files.append(os.path.join(root,filename))
-            
-    return files
+def parse_qc(filename):
+    # The commands of a .qc as [(command, arguments)], with its includes, variables and macros worked out (see qc.py).
+    # Includes are read once per run, no matter how many .qcs use them.
+    return qc.getReader().read(filename)
 
-abspath = ''
-files = []
+def get_materials(filename):
+    # The $cdmaterials folders of a .qc and the .mdl it builds, as {"cdmaterials": [...], "models": [...]} named like
+    # assets.DependencyGraph names them. The names of the materials are in the meshes, not the .qc, so every material
+    # in those folders could be used.
+    materials = {"cdmaterials": [], "models": []}
+    for command, args in parse_qc(filename):
+        if command == '$cdmaterials' and args and isinstance(args[0], str):
+            materials["cdmaterials"].append(assets.normalizePath(fix_path(args[0])))
+        elif command == '$modelname' and args and isinstance(args[0], str):
+            materials["models"].append(assets.normalizePath(fix_path(args[0])))
+    return materials
 
-# recursively search all dirs and files
-for path in sys.argv:
-    abspath = os.path.abspath(path)
-    if os.path.isdir(abspath):
-        files.extend(walk_dir(abspath))
-        break
-    #else:
-    #    if abspath.lower().endswith(INPUT_FILE_EXT):
-    #        files.append(abspath)
+def walk_dir(dirname, inventory = None, rescan = False):
+    # inventory is an AssetInventory (see assets.py) to take the files from, when the folder was already walked.
+    # Otherwise the asset index in the _imported folder is used, rescan lists every folder again.
+    if inventory is None:
+        inventory = assets.loadInventory(dirname, rescan=rescan)
+    return inventory.getFiles("qc", dirname)
 
 def putl(f, line, indent = 0):
     f.write(('\t' * indent) + line + '\r\n')
@@ -72,7 +80,7 @@ def strip_quotes(s):
 def fix_path(s):
     return strip_quotes(s).replace('\\', '/').replace('//', '/').strip('/')
 
-def relative_path(s, base):
+def relative_path(s, base, abspath):
     base = base.replace(abspath, '')
     base = base.replace(os.path.basename(base), '')
 
@@ -82,40 +90,210 @@ def relative_path(s, base):
 def get_mesh_name(file):
     return os.path.splitext(os.path.basename(fix_path(file)))[0]
 
-for filename in files:
+def get_source_file(s):
+    # studiomdl adds .smd to mesh and animation files given without an extension
+    return s if os.path.splitext(fix_path(s))[1] else s + '.smd'
 
-    out_name = filename.replace(INPUT_FILE_EXT, OUTPUT_FILE_EXT)
+def get_options(args):
+    # The words after a command's file, and in its { } blocks, in lowercase
+    options = []
+    for arg in args:
+        if isinstance(arg, list):
+            options.extend(get_options(arg))
+        elif arg is not None:
+            options.append(arg.lower())
+    return options
+
+def get_number(s, default):
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return default
 
-    if os.path.exists(out_name): continue
+def get_option_value(options, name, default):
+    # The number after an option (i.e. fps 30), or default
+    if name in options and options.index(name) + 1 < len(options):
+        return get_number(options[options.index(name) + 1], default)
+    return default
 
-    print('Converting', os.path.basename(filename))
+def format_value(value, depth):
+    # A KeyValues3 value: strings are quoted, lists are arrays and lists of (key, value) are objects
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, str):
+        return '"' + value + '"'
+    if all(isinstance(item, (int, float)) for item in value):
+        # vectors
+        return '[ ' + ', '.join(format_value(item, depth) for item in value) + ' ]'
+    indent = '    ' * depth
+    if value and isinstance(value[0], tuple):
+        lines = ['{']
+        for key, item in value:
+            if isinstance(item, list) and not all(isinstance(i, (int, float)) for i in item):
+                lines.append(indent + '    ' + key + ' =')
+                lines.append(indent + '    ' + format_value(item, depth + 1))
+            else:
+                lines.append(indent + '    ' + key + ' = ' + format_value(item, depth + 1))
+        lines.append(indent + '}')
+    else:
+        lines = ['['] + [indent + '    ' + format_value(item, depth + 1) + ',' for item in value] + [indent + ']']
+    return '\n'.join(lines)
 
-    qc_params = []
-    
-    with open(filename, 'r') as qc_file:
-        qc_params = parse_qc(qc_file.read())
+def format_list(name, items):
+    # One of the m_<name>List = { m_<name>List = [ ... ] } sections of a .vmdl, for a list of objects
+    items_str = '\n            '.join(format_value(item, 3) + ',' for item in items)
+    return VMDL_LIST.replace('<name>', name).replace('<items>', items_str)
+
+def convert_qc(filename, abspath):
+    # Writes the .vmdl for one .qc next to it and returns its file name, or None if there already is one.
+    # abspath is the folder being converted, mesh paths are made relative to it.
+    out_name = filename.replace(INPUT_FILE_EXT, OUTPUT_FILE_EXT)
+
+    if os.path.exists(out_name): return None
 
     cdmaterials = ''
     meshes = []
+    lods = []           # (switch point, {mesh name: file it's replaced with, None if it's removed})
+    animations = []     # (name, file, fps, loop)
+    physics = []        # (file, mass, concave)
+    hitbox_sets = []    # (name, [(bone, group, mins, maxs)])
+
+    for command, args in parse_qc(filename):
+        args = args + [None, None]
+        if command in ['$model', '$body'] and isinstance(args[1], str):
+            meshes.append((args[0], get_source_file(args[1])))
+        elif command == '$bodygroup' and isinstance(args[1], list):
+            # every studio "mesh.smd" in the block, blank ones have nothing to import
+            block = args[1] + [None]
+            for i, p in enumerate(block[:-1]):
+                if isinstance(p, str) and p.lower() == 'studio' and isinstance(block[i+1], str):
+                    meshes.append((args[0], get_source_file(block[i+1])))
+        elif command == '$cdmaterials' and not cdmaterials and isinstance(args[0], str): # just use first $cdmaterials
+            cdmaterials = args[0]
+        elif command == '$lod' and isinstance(args[0], str) and isinstance(args[1], list):
+            # replacemodel "mesh" "mesh_lod1" and removemodel "mesh" lines
+            replacements = {}
+            block = args[1] + [None, None]
+            for i, p in enumerate(block[:-2]):
+                if not isinstance(p, str) or not isinstance(block[i+1], str):
+                    continue
+                if p.lower() == 'replacemodel' and isinstance(block[i+2], str):
+                    replacements[get_mesh_name(block[i+1])] = get_source_file(block[i+2])
+                elif p.lower() == 'removemodel':
+                    replacements[get_mesh_name(block[i+1])] = None
+            lods.append((get_number(args[0], 0.0), replacements))
+        elif command in ['$sequence', '$animation'] and isinstance(args[0], str) and args[1] is not None:
+            # $sequence name file options..., or the way Crowbar writes them, $sequence name { file options... }
+            if isinstance(args[1], list):
+                block_start = next((i for i, p in enumerate(args[1]) if isinstance(p, str)), None)
+                if block_start is None:
+                    continue
+                anim_file = args[1][block_start]
+                option_args = args[1][block_start+1:] + args[2:]
+            else:
+                anim_file = args[1]
+                option_args = args[2:]
+            # sequences can also play an $animation by name, which is in the list already
+            if any(animation[0] in [args[0], anim_file] for animation in animations):
+                continue
+            options = get_options(option_args)
+            animations.append((args[0], get_source_file(anim_file), get_option_value(options, 'fps', 30.0), 'loop' in options))
+        elif command in ['$collisionmodel', '$collisionjoints'] and isinstance(args[0], str):
+            options = get_options(args[1:])
+            physics.append((get_source_file(args[0]), get_option_value(options, '$mass', 0.0), '$concave' in options))
+        elif command == '$hboxset' and isinstance(args[0], str):
+            hitbox_sets.append((args[0], []))
+        elif command == '$hbox' and len(args) >= 10 and all(isinstance(arg, str) for arg in args[:8]):
+            if not hitbox_sets:
+                hitbox_sets.append(('default', []))
+            bounds = [get_number(arg, 0.0) for arg in args[2:8]]
+            hitbox_sets[-1][1].append((args[1], int(get_number(args[0], 0)), bounds[:3], bounds[3:]))
 
-    # naïve method of getting mesh list
-    for i, p in enumerate(qc_params):
-        if p in ['$model', '$body']:
-            meshes.append((qc_params[i+1], qc_params[i+2]))
-        elif p == '$bodygroup':
-            meshes.append((qc_params[i+1], qc_params[i+4]))
-        elif p == '$cdmaterials' and not cdmaterials: # just use first $cdmaterials
-            cdmaterials = qc_params[i+1]
+    # meshes only some LODs use are imported too. Every path already has its .smd (see get_source_file), so the same
+    # file is only listed once however the .qc names it
+    mesh_files = []
+    for mesh_file in [m[1] for m in meshes] + [f for switch_point, replacements in lods for f in replacements.values()]:
+        if mesh_file is not None and mesh_file not in mesh_files:
+            mesh_files.append(mesh_file)
 
     meshes_str = ''
-    for m in meshes:
+    for mesh_file in mesh_files:
         meshes_str += VMDL_MESH.format(
-            mesh_name=get_mesh_name(m[1]), # ignore specified mesh name for now
-            mesh_file=relative_path(m[1], filename),
+            mesh_name=get_mesh_name(mesh_file), # ignore specified mesh name for now
+            mesh_file=relative_path(mesh_file, filename, abspath),
             cdmaterials=MATERIALS_DIR_BASE + fix_path(cdmaterials)
         )
 
+    lists = ''
+    if lods:
+        # LOD 0 is every mesh, the others swap (or drop) the ones their $lod replaces
+        lod_groups = [[('m_flSwitchPoint', 0.0), ('m_meshes', [get_mesh_name(m[1]) for m in meshes])]]
+        for switch_point, replacements in sorted(lods, key=lambda lod: lod[0]):
+            lod_meshes = []
+            for m in meshes:
+                mesh_file = replacements.get(get_mesh_name(m[1]), m[1])
+                if mesh_file is not None:
+                    lod_meshes.append(get_mesh_name(mesh_file))
+            lod_groups.append([('m_flSwitchPoint', switch_point), ('m_meshes', lod_meshes)])
+        lists += format_list('m_lodGroupList', lod_groups)
+    if animations:
+        lists += format_list('m_animationList', [[
+            ('m_animationName', name),
+            ('m_animationFile', relative_path(anim_file, filename, abspath)),
+            ('m_flFrameRate', fps),
+            ('m_bLoop', loop),
+        ] for name, anim_file, fps, loop in animations])
+    if physics:
+        lists += format_list('m_physicsShapeList', [[
+            ('m_meshFile', relative_path(phys_file, filename, abspath)),
+            ('m_flMass', mass),
+            ('m_bConcave', concave),
+        ] for phys_file, mass, concave in physics])
+    if hitbox_sets:
+        lists += format_list('m_hitboxSetList', [[
+            ('m_name', name),
+            ('m_hitboxList', [[
+                ('m_boneName', bone),
+                ('m_nGroupId', group),
+                ('m_vMinBounds', mins),
+                ('m_vMaxBounds', maxs),
+            ] for bone, group, mins, maxs in hitboxes]),
+        ] for name, hitboxes in hitbox_sets])
+
     #out = sys.stdout
 
     with open(out_name, 'w') as out:
-        putl(out, VMDL_BASE.replace('<meshes>', meshes_str).replace((' ' * 4), '\t'))
+        putl(out, VMDL_BASE.replace('<meshes>', meshes_str).replace('<lists>', lists).replace((' ' * 4), '\t'))
+    return out_name
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Generates .vmdl files from the .qc files of decompiled models.')
+    arg_parser.add_argument('path', help='models folder to convert')
+    arg_parser.add_argument('--rescan', action='store_true', help='ignore the asset index and look in every folder again')
+    args = arg_parser.parse_args()
+
+    files = []
+
+    # recursively search all dirs and files
+    abspath = os.path.abspath(args.path)
+    if os.path.isdir(abspath):
+        files.extend(walk_dir(abspath, rescan=args.rescan))
+    #else:
+    #    if abspath.lower().endswith(INPUT_FILE_EXT):
+    #        files.append(abspath)
+
+    for filename in files:
+        if os.path.exists(filename.replace(INPUT_FILE_EXT, OUTPUT_FILE_EXT)): continue
+
+        print('Converting', os.path.basename(filename))
+        try:
+            convert_qc(filename, abspath)
+        except (OSError, qc.QCError) as error:
+            print('- ERROR:', error, 'Skipping!')
+
+if __name__ == '__main__':
+    main()
@@ -23,32 +23,59 @@
 # Usage Instructions:
 # Place all vmts and vtfs in their proper folder structure up till "materials"
 # (we'd recomend you just drop it in the content folder for ease of use)
-# Using VTFCmd or VTFEdit, use Tools->Convert Folder and convert your entire .vtf folder to .tgas
+# Textures are read straight from the .vtfs. If a texture has no .vtf, a .tga with the same name is used instead,
+# so folders already converted with VTFEdit's Tools->Convert Folder still work
 # cmd: python vmt_to_vmat.py PATH
 # i.e.: python vmt_to_vmat.py "C:\Program Files (x86)\Steam\steamapps\common\Half-Life Alyx\content\hl2\materials\models\alyx"
 # OR
 # i.e.: python vmt_to_vmat.py "C:\Program Files (x86)\Steam\steamapps\common\Half-Life Alyx\content\hl2\materials\models\alyx\alyx_faceandhair.vmt"
+# Add --jobs N to convert with N worker processes (--jobs 0 uses every CPU core)
+# Add --stats to see where the time went (reading, decoding, writing...), --trace FILE for the same per material
 
 import sys
 import os
 import os.path
 from os import path
 import re
+import argparse
+import json
+import hashlib
+import time
+import csv
+import cProfile
+import pstats
+from contextlib import contextmanager
 from shutil import copyfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from collections import OrderedDict
 
 from PIL import Image
-import PIL.ImageOps
+
+import keyvalues
+import vtf
+import assets
+import mdl
+import qc
+import mdl_to_vmdl
+import qc_to_vmdl
 
 #import numpy as np
 #from blend_modes import blending_functions
 
-#for the future
-#from VTFLibWrapper.VTFLibEnums import ImageFlag
-#from VTFLibWrapper import VTFLib
-#from VTFLibWrapper import VTFLibEnums
-#vtf_lib = VTFLib.VTFLib()
+# Lookup table for PIL's Image.point() that inverts a band, repeated once per band of the image
+invertTable = [255 - i for i in range(256)]
+
+# File formats textures can be written in, with the options PIL's save() gets for them. .tgas are run length encoded,
+# which most masks (flat, or only a couple of values) shrink to almost nothing with, at about the speed of writing
+# them uncompressed. .pngs use the fastest level of compression for the same reason.
+textureFormats = {
+    ".tga": {"compression": "tga_rle"},
+    ".png": {"compress_level": 1},
+}
+
 
-# File format of the textures.
+# File format of the textures, one of textureFormats (--texture-format picks another one without editing this)
 TEXTURE_FILEEXT = '.tga'
 # Extension added to the end of the target folder for these new materials. Valve uses _imported, so we're using it here too
 TARGET_FOLDER_EXTENSION = "_imported"
@@ -58,6 +85,23 @@ PBR_HACK = False
 # A lot of looks for Source games seem to hinge on Reflectance Range being correct, so for now, we're making
 # a seperate variable for it to make it easier to modify on a per-game basis. HL2 seems to be 0.5
 reflRange = 0.5
+# Name of the incremental build manifest, kept in the root of the _imported folder. It remembers what every .vmat
+# was built from, so re-runs only redo the materials whose .vmt, textures or settings changed.
+MANIFEST_FILENAME = "vmt_to_vmat_manifest.jsonl"
+# Goes up whenever what the manifest records changes, so entries written by older versions are rebuilt once
+MANIFEST_VERSION = 2
+# How much memory (in MB) each process may use to keep decoded textures around for the next material that uses them.
+# Team colour variants, skins and LODs tend to share their textures, so this saves a lot of decoding. 0 turns it off.
+TEXTURE_CACHE_MB = 256
+# Write maps derived from shared textures (the _color of X, the alpha of X...) once, named after the source texture,
+# instead of once per material. All the .vmats using X then point at the same file, like $detail textures already do.
+SHARE_DERIVED_TEXTURES = False
+# Largest size (in pixels, along the longest side) to write each type of map at, i.e. {"selfillum": 1024, "ao": 512}.
+# Bigger textures are read from the first mip level that fits (or scaled down, for .tgas). Map types not listed are
+# written at full size. Masks like _selfillum and _colormask rarely need the full resolution of a 4K texture.
+MAX_TEXTURE_SIZE = {}
+# Map types MAX_TEXTURE_SIZE knows about, named after the suffix of the file they end up in
+textureMapTypes = ["color", "normal", "ao", "rough", "selfillum", "trans", "colormask"]
 # If the user wishes, they can also generate .vmats for tools files (so debug, tools, dev, etc.) but usually this
 # causes compatibility issues since S2 already has it's own versions.
 skipDebugFiles = True
@@ -75,7 +119,7 @@ vmtSupportedShaders = [
 "vertexlitgeneric",         # + Convert to VR Complex
 "unlitgeneric",             # TODO: Convert to VR Complex, selfIllum with white mask
 "unlittwotexture",          # TODO: Vr Simple 2layer Parallax?
-"patch",                    # TODO: ughhhhhhhhhhhhhhhhhhhhhhhhh
+# "patch" isn't here on purpose, MaterialStore resolves patches to the shader of the material they include
 "teeth",                    # + Convert to VR Complex
 "eyes",                     # + Convert to VR Complex
 "eyeball",                  # + Convert to VR Complex
@@ -93,100 +137,515 @@ vmtSupportedShaders = [
 "decalmodulate",            # TODO: See if this needs extra work
 "cables"                    # TODO: Find appropriate shader or maybe just vr_complex?
 ]
-ignoreList = [
-"vertexlitgeneric_hdr_dx9",
-"vertexlitgeneric_dx9",
-"vertexlitgeneric_dx8",
-"vertexlitgeneric_dx7",
-"lightmappedgeneric_hdr_dx9",
-"lightmappedgeneric_dx9",
-"lightmappedgeneric_dx8",
-"lightmappedgeneric_dx7",
-]
+# Every .vmt parameter that points at a texture we might read. Lives in assets.py, which indexes them as well
+vmtTextureParameters = assets.materialTextureParameters
 
 ###
 ### Classes
 ###
 class RGBAImage:
-    r = None
-    g = None
-    b = None
-    a = None
-
+    # Packs channels of other images into one texture, i.e. R = AO, G = roughness, B = metalness.
+    # Every source image is converted, resized and inverted once as a whole (PIL does these in one pass over all
+    # its bands) and the channels only point into it. Bands are only split out and merged when the image is asked
+    # for, and not at all if every channel comes from the same place in one source. Channels that were never set
+    # are filled with col.
     def __init__(self, size, col):
-        self.r,self.g,self.b,self.a = Image.new("RGBA", size, col).split()
+        self.size = size
+        self.col = col
+        self.bands = [None, None, None, None]   # (image, band of it or None for greyscale images)
 
     def resizeAll(self, newSize):
-        self.r = self.r.resize(newSize)
-        self.g = self.g.resize(newSize)
-        self.b = self.b.resize(newSize)
-        self.a = self.a.resize(newSize)
+        resized = {}
+        for i, band in enumerate(self.bands):
+            if band:
+                image, sourceChannel = band
+                if id(image) not in resized:
+                    resized[id(image)] = image.resize(newSize)
+                self.bands[i] = (resized[id(image)], sourceChannel)
+        self.size = newSize
+
+    def setChannels(self, channels, image, flip = False, sourceChannels = None):
+        # Fills channels (i.e. "RGB") from image. Greyscale images go into all of them, otherwise each one comes
+        # from the band of image with the same name, or the one at the same place in sourceChannels if given.
+        sourceChannels = sourceChannels or channels
+        if image.mode != "L":
+            if len(set(sourceChannels)) == 1:
+                # just the one band, there's no need to carry the rest around
+                if sourceChannels[0] not in image.getbands():
+                    image = image.convert("RGBA")
+                image = image.getchannel(sourceChannels[0])
+            else:
+                mode = "RGB" if set(sourceChannels) <= set("RGB") else "RGBA"
+                if image.mode != mode:
+                    image = image.convert(mode)
+        if image.size != self.size:
+            image = image.resize(self.size)
+        if flip:
+            image = image.point(invertTable * len(image.getbands()))
+        for channel, sourceChannel in zip(channels, sourceChannels):
+            self.bands["RGBA".index(channel)] = (image, None if image.mode == "L" else sourceChannel)
 
     def setRG(self, image, flip = False):
-        self.r.resize(image.size)
-        self.g.resize(image.size)
-        if (flip):
-            self.r = PIL.ImageOps.invert(image)
-            self.g = PIL.ImageOps.invert(image)
-        else:
-            self.r = image
-            self.g = image
+        self.setChannels("RG", image, flip)
 
     def setRGB(self, image, flip = False):
-        self.r.resize(image.size)
-        self.g.resize(image.size)
-        self.b.resize(image.size)
-
-        if(flip):
-            self.r = PIL.ImageOps.invert(image)
-            self.g = PIL.ImageOps.invert(image)
-            self.b = PIL.ImageOps.invert(image)
-        else:
-            self.r = image
-            self.g = image
-            self.b = image
+        self.setChannels("RGB", image, flip)
 
     def setRGBA(self, image, flip = False):
-        self.r.resize(image.size)
-        self.g.resize(image.size)
-        self.b.resize(image.size)
-        self.a.resize(image.size)
-
-        if(flip):
-            self.r = PIL.ImageOps.invert(image)
-            self.g = PIL.ImageOps.invert(image)
-            self.b = PIL.ImageOps.invert(image)
-            self.a = PIL.ImageOps.invert(image)
-        else:
-            self.r = image
-            self.g = image
-            self.b = image
-            self.a = image
+        self.setChannels("RGBA", image, flip)
+
+    def getBand(self, i):
+        if self.bands[i] is None:
+            return Image.new("L", self.size, self.col[i])
+        image, sourceChannel = self.bands[i]
+        return image if sourceChannel is None else image.getchannel(sourceChannel)
+
+    def getImage(self, mode = "RGBA"):
+        source = self.bands[0][0] if self.bands[0] else None
+        if source is not None and source.mode == mode and \
+                all(band and band[0] is source and band[1] == channel for band, channel in zip(self.bands, mode)):
+            return source
+        return Image.merge(mode, [self.getBand(i) for i in range(len(mode))])
 
     def saveFile(self, filePath):
-        imageOut = Image.merge('RGBA', (self.r, self.g, self.b, self.a))
-        imageOut.save(filePath)
-        imageOut.close()
+        self.getImage().save(filePath)
+
+class ConverterSettings:
+    # Everything a worker needs to convert a material. Passed to every convertMaterial() call since
+    # worker processes don't see anything main() sets up.
+    shader = "vr_complex"
+    overwriteVmat = True
+    overwriteTga = False
+    pbrHack = PBR_HACK
+    reflRange = reflRange
+    textureCacheMB = TEXTURE_CACHE_MB
+    shareDerivedTextures = SHARE_DERIVED_TEXTURES
+    maxTextureSize = MAX_TEXTURE_SIZE
+    textureFileExt = TEXTURE_FILEEXT
+    runStartTime = 0.0
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def manifestKey(self):
+        # Only the settings that change what ends up in the output files, overwrite choices don't count
+        return json.dumps([MANIFEST_VERSION, self.shader, self.reflRange, self.pbrHack, self.textureFileExt, self.shareDerivedTextures,
+                           sorted(self.maxTextureSize.items())])
+
+class MaterialResult:
+    # What convertMaterial() hands back: the log lines for one material and whether it was converted.
+    # status is one of "converted", "skipped" or "error".
+    def __init__(self, vmtFileName, overwrite = False, runStartTime = 0.0):
+        self.vmtFileName = vmtFileName
+        self.vmatFileName = ""
+        self.status = "skipped"
+        self.logLines = []
+        self.overwrite = overwrite
+        self.runStartTime = runStartTime
+        self.inputs = {}    # every file this material was built from, with its fileSignature()
+        self.outputs = []   # every file this material wrote (or would have, if it didn't exist yet)
+        self.phases = {}    # phase: [seconds, calls] spent on it converting this material, see timed()
+        self.counters = {}  # i.e. bytes read and written, cache hits and misses, see count()
+        self.phaseStack = []
+
+    def log(self, message):
+        self.logLines.append(message)
+
+    def startPhase(self, phase):
+        # The phase it's in is paused until this one ends, so every second goes to exactly one phase
+        now = time.perf_counter()
+        if self.phaseStack:
+            self.addTime(self.phaseStack[-1], now)
+        self.phaseStack.append([phase, now])
+
+    def endPhase(self):
+        now = time.perf_counter()
+        phase = self.phaseStack.pop()
+        self.addTime(phase, now)
+        self.phases[phase[0]][1] += 1
+        if self.phaseStack:
+            self.phaseStack[-1][1] = now
+
+    def addTime(self, phase, now):
+        entry = self.phases.setdefault(phase[0], [0.0, 0])
+        entry[0] += now - phase[1]
+
+    def claimOutput(self, fileName, shared = False):
+        # Records fileName as an output of this material and returns whether it needs to be (re)written
+        self.outputs.append(fileName)
+        if not os.path.exists(fileName):
+            return True
+        if shared:
+            # don't redo it if another material (maybe in another worker) already wrote it during this run
+            return self.overwrite and os.path.getmtime(fileName) < self.runStartTime
+        return self.overwrite
+
+    def printLog(self, log = print):
+        log('\n'.join(self.logLines))
+
+class BuildManifest:
+    # JSON lines file with one entry per .vmt: the signatures of its inputs, the settings it was built with
+    # and the files it wrote. Only the main process touches it, workers just report back in MaterialResult.
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(fileName):
+            with open(fileName, 'r') as manifestFile:
+                for line in manifestFile:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["vmt"]] = entry
+
+    def hasEntry(self, vmtFileName):
+        return vmtFileName in self.entries
+
+    def isUpToDate(self, vmtFileName, settingsKey):
+        entry = self.entries.get(vmtFileName)
+        if entry is None or entry["settings"] != settingsKey:
+            return False
+        for inputPath, signature in entry["inputs"].items():
+            if not signatureMatches(inputPath, signature):
+                return False
+            if signature is not None and signatureTouched(inputPath, signature):
+                # same contents, new timestamp. Remember the new stat so we don't hash it again next time
+                entry["inputs"][inputPath] = fileSignature(inputPath, signature[2])
+                self.changed = True
+        for outputPath in entry["outputs"]:
+            if not os.path.exists(outputPath):
+                return False
+        return True
+
+    def update(self, result, settingsKey):
+        if result.status == "skipped":
+            return
+        self.entries[result.vmtFileName] = {
+            "vmt": result.vmtFileName,
+            "settings": settingsKey,
+            "inputs": result.inputs,
+            "outputs": result.outputs,
+        }
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.fileName), exist_ok=True)
+        tmpFileName = self.fileName + '.tmp'
+        with open(tmpFileName, 'w') as manifestFile:
+            for vmtFileName in sorted(self.entries):
+                manifestFile.write(json.dumps(self.entries[vmtFileName]) + '\n')
+        os.replace(tmpFileName, self.fileName)
+        self.changed = False
+
+class ConversionStats:
+    # The phases and counters of every MaterialResult of a run added up, plus the phases timed in the main process
+    # (walking the folders, checking the manifest). The phases are summed over every worker, so with more than one
+    # job they add up to more than the wall time.
+    def __init__(self):
+        self.phases = {}    # phase: [seconds, calls]
+        self.counters = {}
+        self.statuses = {}
+        self.results = []
+        self.wallTime = 0.0
+        self.jobs = 1
+
+    def addPhase(self, phase, seconds, calls = 1):
+        entry = self.phases.setdefault(phase, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+    def add(self, result):
+        for phase, (seconds, calls) in result.phases.items():
+            self.addPhase(phase, seconds, calls)
+        for counter, value in result.counters.items():
+            self.counters[counter] = self.counters.get(counter, 0) + value
+        self.statuses[result.status] = self.statuses.get(result.status, 0) + 1
+        self.results.append(result)
+
+    def formatTable(self):
+        total = sum(seconds for seconds, calls in self.phases.values())
+        lines = ['+ %-22s %10s %7s %8s' % ("Phase", "Time (s)", "Share", "Calls")]
+        for phase, (seconds, calls) in sorted(self.phases.items(), key=lambda item: -item[1][0]):
+            lines.append('+ %-22s %10.3f %6.1f%% %8d' % (phase, seconds, 100 * seconds / total if total else 0, calls))
+        lines.append('+ %-22s %10.3f' % ("total", total))
+        for counter, value in sorted(self.counters.items()):
+            if counter.startswith('bytes'):
+                lines.append('+ %-22s %10.1f MB' % (counter, value / (1024 * 1024)))
+            else:
+                lines.append('+ %-22s %10d' % (counter, value))
+        materials = ', '.join(str(number) + ' ' + status for status, number in sorted(self.statuses.items()))
+        lines.append('+ %d materials (%s) in %.3fs wall time with %d jobs' % (len(self.results), materials or 'none',
+                                                                             self.wallTime, self.jobs))
+        return '\n'.join(lines)
+
+    def writeTrace(self, fileName):
+        # A .csv gets one row per material with a column for every phase (seconds) and counter, anything else the
+        # whole run as JSON
+        if fileName.lower().endswith('.csv'):
+            phases = sorted({phase for result in self.results for phase in result.phases})
+            counters = sorted({counter for result in self.results for counter in result.counters})
+            with open(fileName, 'w', newline='') as traceFile:
+                writer = csv.writer(traceFile)
+                writer.writerow(["vmt", "status", "total"] + phases + counters)
+                for result in self.results:
+                    writer.writerow([result.vmtFileName, result.status, '%.6f' % sum(seconds for seconds, calls in result.phases.values())]
+                                    + ['%.6f' % result.phases.get(phase, [0.0])[0] for phase in phases]
+                                    + [result.counters.get(counter, 0) for counter in counters])
+            return
+        with open(fileName, 'w') as traceFile:
+            json.dump({
+                "wallTime": self.wallTime,
+                "jobs": self.jobs,
+                "phases": self.phases,
+                "counters": self.counters,
+                "statuses": self.statuses,
+                "materials": [{"vmt": result.vmtFileName, "status": result.status, "phases": result.phases,
+                               "counters": result.counters} for result in self.results],
+            }, traceFile, indent=1)
+
+class TextureError(Exception):
+    # A texture whose header was fine but whose pixels couldn't be decoded (truncated .vtf, corrupt .tga...). Maps are
+    # only decoded once they're needed, long after the texture was opened, so convertMaterial() catches these for the
+    # whole material.
+    def __init__(self, fileName, reason):
+        Exception.__init__(self, fileName + " could not be read: " + reason)
+        self.fileName = fileName
+        self.reason = reason
+
+class TextureHandle:
+    # A texture (or one channel of it) whose header has been read but that hasn't been decoded yet. Materials hold on
+    # to these and only decode them, at the size their map type needs, once a map actually has to be written.
+    # getchannel() and convert() work like PIL's, but just return another handle.
+    def __init__(self, cache, fileName, key, size, textureMode, vtfFile = None, channel = None, convertMode = None):
+        self.cache = cache
+        self.fileName = fileName
+        self.key = key  # (texture path, mtime) like TextureCache.getKey()
+        self.size = size
+        self.textureMode = textureMode  # mode of the whole texture once decoded
+        self.vtfFile = vtfFile
+        self.channel = channel
+        self.convertMode = convertMode
+        self.mode = convertMode or ("L" if channel else textureMode)
+        self.info = {'source': (key[0], channel)}
+        if vtfFile is not None:
+            self.mipCount = vtfFile.mipCount
+        else:
+            self.mipCount = max(size).bit_length()  # a .tga has no mips, but we can make them
+
+    def variant(self, channel, convertMode):
+        return TextureHandle(self.cache, self.fileName, self.key, self.size, self.textureMode, self.vtfFile, channel, convertMode)
+
+    def getchannel(self, channel):
+        if self.channel is not None or channel not in self.textureMode:
+            raise ValueError(self.fileName + " has no " + channel + " channel")
+        return self.variant(channel, None)
+
+    def convert(self, mode):
+        return self.variant(self.channel, mode)
+
+    def getMipSize(self, level):
+        return max(1, self.size[0] >> level), max(1, self.size[1] >> level)
+
+    def getLevel(self, maxSize):
+        # The biggest mip level that fits in maxSize (0 means no limit), or the smallest one there is
+        level = 0
+        if maxSize > 0:
+            while max(self.getMipSize(level)) > maxSize and level < self.mipCount - 1:
+                level += 1
+        return level
+
+    def load(self, maxSize = 0):
+        return self.cache.load(self, self.getLevel(maxSize))
+
+class AlphaInfo:
+    # What a texture's alpha channel holds, from TextureCache.getAlphaInfo(). Textures without one count as fully
+    # opaque, the way Source 1 samples them.
+    def __init__(self, hasAlpha, low = 255, high = 255, binary = True):
+        self.hasAlpha = hasAlpha
+        self.min = low
+        self.max = high
+        self.binary = binary    # every pixel is either fully transparent or fully opaque
+
+    def isFlat(self):
+        return self.min == self.max
+
+class TextureCache:
+    # Decoded textures, and channels pulled out of them, kept around for the other materials converted by this process.
+    # Keyed on the texture path from the .vmt plus the file's mtime, so an edited texture is never handed out stale,
+    # and on the mip level, channel and mode that was asked for.
+    # Least recently used entries are dropped once they go over the memory budget.
+    # Images handed out are shared, so never modify them in place (convert/getchannel/invert all make copies).
+    def __init__(self, budgetMB):
+        self.budgetMB = budgetMB
+        self.budget = budgetMB * 1024 * 1024
+        self.used = 0
+        self.entries = OrderedDict()
+        self.alphaInfo = {}     # texture key: AlphaInfo, small enough to keep for every texture seen
+        self.hits = 0
+        self.misses = 0
+
+    def getKey(self, textureFileName, texturePath):
+        return (parseVMTPath(texturePath).replace('\\', '/'), os.stat(textureFileName).st_mtime_ns)
+
+    def lookup(self, key):
+        image = self.entries.get(key)
+        if image is None:
+            self.misses += 1
+            count("texture_cache_misses")
+            return None
+        self.hits += 1
+        count("texture_cache_hits")
+        self.entries.move_to_end(key)
+        return image
+
+    def store(self, key, image):
+        size = image.size[0] * image.size[1] * len(image.getbands())
+        if size > self.budget:
+            return
+        self.entries[key] = image
+        self.used += size
+        while self.used > self.budget:
+            oldKey, oldImage = self.entries.popitem(last=False)
+            self.used -= oldImage.size[0] * oldImage.size[1] * len(oldImage.getbands())
+
+    def open(self, textureFileName, texturePath):
+        # Only reads the header, so missing or broken files are still caught here rather than when it's decoded
+        with timed("texture_open"):
+            key = self.getKey(textureFileName, texturePath)
+            if textureFileName.lower().endswith('.vtf'):
+                vtfFile = vtf.VTFFile(textureFileName)
+                return TextureHandle(self, textureFileName, key, (vtfFile.width, vtfFile.height), vtfFile.mode, vtfFile)
+            with Image.open(textureFileName) as image:
+                return TextureHandle(self, textureFileName, key, image.size, image.mode)
+
+    def load(self, handle, level):
+        key = handle.key + (handle.channel, handle.convertMode, level)
+        image = self.lookup(key)
+        if image is None:
+            if handle.convertMode is not None:
+                image = self.load(handle.variant(handle.channel, None), level)
+                with timed("map_build"):
+                    image = image.convert(handle.convertMode)
+            elif handle.channel is not None:
+                # Keep just the channel, the whole texture is only reused if something else already decoded it
+                image = self.entries.get(handle.key + (None, None, level))
+                if image is None:
+                    image = self.decode(handle, level)
+                with timed("map_build"):
+                    image = image.getchannel(handle.channel)
+            else:
+                image = self.decode(handle, level)
+            image.info['source'] = handle.info['source']
+            self.store(key, image)
+        return image
+
+    def getAlphaInfo(self, handle):
+        # Looks at a texture's alpha channel once, so materials can tell whether it's worth taking out at all.
+        # Textures whose header says there's no alpha aren't decoded for it.
+        info = self.alphaInfo.get(handle.key)
+        if info is None:
+            if "A" not in handle.textureMode or (handle.vtfFile is not None and not handle.vtfFile.hasAlpha()):
+                info = AlphaInfo(False)
+            else:
+                # one pass in C over the channel, which the maps made from it then reuse from the cache
+                alphaChannel = self.load(handle.variant("A", None), 0)
+                with timed("analysis"):
+                    histogram = alphaChannel.histogram()
+                values = [value for value, count in enumerate(histogram) if count]
+                info = AlphaInfo(True, values[0], values[-1], all(value in (0, 255) for value in values))
+            self.alphaInfo[handle.key] = info
+        return info
+
+    def decode(self, handle, level):
+        if level > 0 and handle.vtfFile is None:
+            image = self.load(handle.variant(None, None), 0)
+            with timed("map_build"):
+                return image.resize(handle.getMipSize(level), Image.BOX)
+        try:
+            with timed("texture_decode"):
+                if handle.vtfFile is not None:
+                    width, height = handle.vtfFile.getMipSize(min(level, handle.vtfFile.mipCount - 1))
+                    count("bytes_read", vtf.getImageDataSize(handle.vtfFile.format, width, height))
+                    return handle.vtfFile.getImage(level)
+                count("bytes_read", os.path.getsize(handle.fileName))
+                image = Image.open(handle.fileName)
+                image.load() # decode now, and let go of the file handle
+                return image
+        except (OSError, ValueError, vtf.VTFError) as error:
+            raise TextureError(handle.fileName, str(error))
+
+class MaterialStore:
+    # Every .vmt read by this process, parsed once and kept for the rest of the run. Patch materials are resolved
+    # here by laying their insert/replace keys over a copy of the included material's parameters, so a base shared
+    # by hundreds of patches (CS:S, L4D2) is only read and parsed once.
+    # Materials handed out are shared, so never modify them in place.
+    def __init__(self):
+        self.materials = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, vmtFileName, log = print):
+        key = (os.path.normcase(os.path.abspath(vmtFileName)), os.stat(vmtFileName).st_mtime_ns)
+        material = self.materials.get(key)
+        if material is None:
+            self.misses += 1
+            count("material_cache_misses")
+            count("bytes_read", os.path.getsize(vmtFileName))
+            with open(vmtFileName, 'r') as vmtFile:
+                material = parseVMT(vmtFile, log)
+            self.materials[key] = material
+        else:
+            self.hits += 1
+            count("material_cache_hits")
+        return material
+
+    def resolve(self, vmtFileName, modPath, log = print, depth = 0):
+        # Returns the material with any patches applied, and every .vmt that went into it
+        material = self.load(vmtFileName, log)
+        if material["shader"] != "patch":
+            return material, [vmtFileName]
+
+        if "include" not in material["parameters"]:
+            log("- ERROR: Patch material " + os.path.basename(vmtFileName) + " has no include. Skipping!")
+            return material, [vmtFileName]
+        if depth > 8:
+            log("- ERROR: Patch material " + os.path.basename(vmtFileName) + " includes too many other patches. Skipping!")
+            return material, [vmtFileName]
+
+        include = material["parameters"]["include"].replace('\\', '/')
+        if not include.startswith('materials/'):
+            include = 'materials/' + include
+        includeFileName = modPath + include
+        if not os.path.exists(includeFileName):
+            log("- ERROR: Patch include " + include + " does not exist. Skipping!")
+            return material, [vmtFileName, includeFileName]
+
+        baseMaterial, files = self.resolve(includeFileName, modPath, log, depth + 1)
+        patched = {"shader": baseMaterial["shader"], "parameters": dict(baseMaterial["parameters"]), "blocks": dict(baseMaterial["blocks"])}
+        # insert adds or overwrites keys, replace only changes the ones the included material already has
+        applyPatchKeys(patched, material["blocks"].get("insert", {}), False)
+        applyPatchKeys(patched, material["blocks"].get("replace", {}), True)
+        return patched, [vmtFileName] + files
+
+# One per process, so every material a worker converts shares them
+textureCache = None
+materialStore = None
+# sha1 of every file hashed by this process, keyed on path, size and mtime so an edited file is hashed again. A texture
+# shared by hundreds of materials is then hashed once instead of once per material.
+fileHashes = {}
+# The MaterialResult of the material this process is converting, which timed() and count() add to
+currentResult = None
 
 ###
 ### Small Functions
 ###
 
 def parseDir(dirName):
-    files = []
-    for root, dirs, fileNames in os.walk(dirName):
-        if not os.path.exists(addFolderExtension(root)):
-            print(" + Target Directory not found for folder " + os.path.basename(root) + ". Creating!")
-            os.makedirs(addFolderExtension(root))
-        for fileName in fileNames:
-            if fileName.lower().endswith('.vmt'):
-                files.append(os.path.join(root,fileName))
-    return files
-
-def parseLine(inputString):
-    #TODO: REGEX????
-    inputString = inputString.lower().replace('"', '').replace("'", "").replace("\n", "").replace("\t", "").replace("{", "").replace("}", "").replace(" ", "")
-    return inputString
+    # Every .vmt under dirName, in a fixed order so the conversion log is the same every run. Target folders aren't
+    # made here, convertMaterial() makes them when it has something to write in them.
+    return assets.walkContent(dirName).getFiles("material")
 
 def fixTexturePath(p, addonString = ""):
     retPath = p.strip().strip('"')
@@ -201,6 +660,26 @@ def fixVector(s, divVar = 1):
     extra = (' 0.0' * max(3 - s.count(' '), 0) )
     return '"[' + ' '.join(parts) + extra + ']"'
 
+def getFlatColor(image):
+    # The band values of an image that's the same colour all over, None if it isn't. getextrema() finds the lowest and
+    # highest value of every band in one pass in C, so this is cheap next to decoding the image.
+    if image.mode not in ("L", "RGB", "RGBA"):
+        image = image.convert("RGBA")
+    extrema = image.getextrema()
+    if image.mode == "L":
+        extrema = (extrema,)
+    if any(low != high for low, high in extrema):
+        return None
+    return [low for low, high in extrema]
+
+def formatConstant(values, flip = False):
+    # Band values (0-255) the way a .vmat writes a colour in place of a texture, "[r g b 0.000]" from 0 to 1.
+    # A single greyscale value goes into all three.
+    rgb = values * 3 if len(values) == 1 else values[:3]
+    if flip:
+        rgb = [255 - value for value in rgb]
+    return '"[' + ' '.join('%.3f' % (value / 255) for value in rgb) + ' 0.000]"'
+
 def vectorToArray(s, divVar = 1):
     s = s.strip('"][}{ ') # some VMT vectors use {}
     parts = [float(i) / divVar for i in s.split(' ')]
@@ -217,174 +696,257 @@ def text_parser(filepath, separator="="):
                 return_dict[line[0]] = line[1]
     return return_dict
 
+@contextmanager
+def timed(phase):
+    # Adds the time spent in the with block to phase of the material being converted, if there is one. Phases inside
+    # other phases only count towards the inner one, so a material's phases add up to the time it took.
+    result = currentResult
+    if result is None:
+        yield
+        return
+    result.startPhase(phase)
+    try:
+        yield
+    finally:
+        result.endPhase()
+
+def count(counter, amount = 1):
+    if currentResult is not None:
+        currentResult.counters[counter] = currentResult.counters.get(counter, 0) + amount
+
+def hashFile(filePath):
+    fileHash = hashlib.sha1()
+    with timed("hash"), open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            fileHash.update(chunk)
+            count("bytes_hashed", len(chunk))
+    return fileHash.hexdigest()
+
+def getFileHash(filePath, stat):
+    key = (os.path.normcase(os.path.abspath(filePath)), stat.st_size, stat.st_mtime_ns)
+    fileHash = fileHashes.get(key)
+    if fileHash is None:
+        fileHash = hashFile(filePath)
+        fileHashes[key] = fileHash
+    return fileHash
+
+def fileSignature(filePath, knownHash = None):
+    # [size, mtime, sha1] of a file, or None if it doesn't exist (a missing texture is an input too,
+    # the material has to be rebuilt once it shows up)
+    try:
+        stat = os.stat(filePath)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns, knownHash or getFileHash(filePath, stat)]
+
+def signatureTouched(filePath, signature):
+    stat = os.stat(filePath)
+    return stat.st_size != signature[0] or stat.st_mtime_ns != signature[1]
+
+def signatureMatches(filePath, signature):
+    # Checks size and mtime first and only hashes the file if those changed, so an untouched tree is just stat calls
+    try:
+        stat = os.stat(filePath)
+    except OSError:
+        return signature is None
+    if signature is None or stat.st_size != signature[0]:
+        return False
+    if stat.st_mtime_ns == signature[1]:
+        return True
+    return getFileHash(filePath, stat) == signature[2]
+
+def getMaterialsFilePath(modPath, vmtPath):
+    # Where a path from a .vmt (relative to materials, with either kind of slash) is on this OS
+    return os.path.join(modPath + "materials", *re.split(r'[\\/]+', parseVMTPath(vmtPath).strip('\\/')))
+
+def findTexture(modPath, texturePath):
+    # The texture's .vtf if there is one, otherwise a .tga with the same name (i.e. from VTFEdit's Convert Folder)
+    fileName = getMaterialsFilePath(modPath, texturePath)
+    if os.path.exists(fileName + ".vtf"):
+        return fileName + ".vtf"
+    return fileName + ".tga"
+
+def getTexturePaths(vmtParameters, modPath):
+    # Every file findTexture() could pick for the material's textures, the .vtf and the .tga, whether they exist or
+    # not. A missing one is an input too, so a .vtf showing up later makes the material stale.
+    texturePaths = []
+    for parameter in vmtTextureParameters:
+        if parameter in vmtParameters:
+            fileName = getMaterialsFilePath(modPath, vmtParameters[parameter])
+            texturePaths.extend([fileName + ".vtf", fileName + ".tga"])
+    return texturePaths
+
+def getTextureCache(settings):
+    global textureCache
+    if textureCache is None or textureCache.budgetMB != settings.textureCacheMB:
+        textureCache = TextureCache(settings.textureCacheMB)
+    return textureCache
+
+def getMaterialStore():
+    global materialStore
+    if materialStore is None:
+        materialStore = MaterialStore()
+    return materialStore
+
+def applyPatchKeys(material, patchKeys, replaceOnly):
+    for key, value in patchKeys.items():
+        if isinstance(value, dict):
+            if not replaceOnly or key in material["blocks"]:
+                material["blocks"][key] = value
+            continue
+        if replaceOnly and key not in material["parameters"]:
+            continue
+        value = value.strip().strip("'")
+        if value == "" or value == "0":
+            # the same as not having it at all, see parseVMT
+            material["parameters"].pop(key, None)
+        else:
+            material["parameters"][key] = value
+
+def getManifestFileName(vmtFileName):
+    return addFolderExtension(vmtFileName).split('materials')[0] + MANIFEST_FILENAME
+
+def saveTexture(image, fileName, shared = False):
+    # Written in whichever of textureFormats the extension of fileName is
+    baseName, extension = os.path.splitext(fileName)
+    options = textureFormats.get(extension.lower(), {})
+    with timed("texture_write"):
+        if shared:
+            # shared textures can be written by several workers at once, so go through a temporary file like copyOnce
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            tmpPath = baseName + '.' + str(os.getpid()) + '.tmp' + extension
+            image.save(tmpPath, **options)
+            os.replace(tmpPath, fileName)
+        else:
+            image.save(fileName, **options)
+        count("textures_written")
+        count("bytes_written", os.path.getsize(fileName))
+
+def copyOnce(src, dst):
+    # Copy to a temporary name first, so two workers copying the same shared file can't leave a half written one
+    with timed("texture_write"):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmpPath = dst + '.' + str(os.getpid()) + '.tmp'
+        copyfile(src, tmpPath)
+        os.replace(tmpPath, dst)
+        size = os.path.getsize(dst)
+        count("textures_copied")
+        count("bytes_read", size)
+        count("bytes_written", size)
+
+def writeTextOnce(fileName, text):
+    # Settings files next to shared textures go through a temporary file too, for the same reason as copyOnce
+    os.makedirs(os.path.dirname(fileName), exist_ok=True)
+    tmpPath = fileName + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpPath, 'w') as textFile:
+        textFile.write(text)
+    os.replace(tmpPath, fileName)
+
 def parseVMTPath(inputPath):
     inputPath = inputPath.lower().replace(".vtf", "")
     return inputPath
 
 def addFolderExtension(filePath):
-    outPath = filePath.split('\\materials')[0] + TARGET_FOLDER_EXTENSION + "\\materials" + filePath.split('materials')[1]
+    # Either kind of slash can come before materials, depending on the OS and where the path came from
+    materialsIndex = re.search(r'[\\/]materials', filePath).start()
+    outPath = filePath[:materialsIndex] + TARGET_FOLDER_EXTENSION + filePath[materialsIndex:]
     return outPath
 
 ###
 ### Big Functions
 ###
-def parseVMTParameter(line, parameters):
-    words = []
-
-    if line.startswith('\t') or line.startswith(' '):
-        words = re.split(r'\s+', line, 2)
-    else:
-        words = re.split(r'\s+', line, 1)
-
-    words = list(filter(len, words))
-    if len(words) < 2:
-        return
-
-    key = words[0].strip('"').lower() # we process all values and keys as lowercase
-
-    if key.startswith('/'):
-        return
-
-    if not key.startswith('$'):
-        if not key.startswith('include'):
-            return
-
-    val = words[1].strip('\n').lower() # we process all values and keys as lowercase
-
-    commentTuple = val.partition('//')
-
-    if (val.strip('"' + "'") == ""):
-        print("+ WARNING: No value found in parameter " + key + ", skipping!")
-        return
-    # So I chose this to be simple in code later, so I don't have to check if a value exists in vmtParameters AND check it's value
-    # But, this should be fine cuz .vmt seems to treat any 0 values as the default parameter. If there's a value out there though
-    # that relies on 0, we can add it here as an exception.
-    if (val.strip('"' + "'") == "0"):
-        print("+ WARNING: Value of " + key + " found to be 0, skipping!")
-        return
-
-    if not commentTuple[0] in parameters:
-        #TODO: Tidy this up with regex
-        parameters[key] = commentTuple[0].replace("'", "").replace('"', '').replace("\n", "").replace("\t", "")
-        # reports back as dict with the format $basetexture models/alyx/alyx_faceandhair
-
-###
-### Main Execution
-###
-
-print('--------------------------------------------------------------------------------------------------------\n'
-      'Source 2 Material Conveter! By Rectus via Github.\nInitially forked by Alpyne, this version by caseytube.\n'
-      '--------------------------------------------------------------------------------------------------------\n')
-print(" + As a reminder, please extract all of your .vtfs to .tga using VTFEdit's 'Convert Folder' before running! + \n")
-# Start by asking some basic questions
-yes = {'yes','y', 'ye'}
-no = {'no','n', ''}
-validS2Shaders = {'vr_complex','vr_standard'}
-convertVTFs = False
-
-targetFolder = input("What folder would you like to convert? Valid Format: C:\\Steam\\steamapps\\Half-Life Alyx\\content\\tf\\materials: ").lower()
-if not os.path.exists(targetFolder):
-    print("Please respond with a valid folder or file path! Quitting Process!")
-    quit()
-
-overwriteInput = input("Would you like to overwrite any existing .vmat files? (y/n): ").lower()
-if overwriteInput in yes:
-    OVERWRITE_VMAT = True
-elif overwriteInput in no:
-    OVERWRITE_VMAT = False
-elif overwriteInput == "": # debug: casey's favorite default value
-    OVERWRITE_VMAT = True
-else:
-    print("Please respond with 'yes' or 'no.' Quitting process!")
-    quit()
-
-overwriteTGAInput = input("Would you like to overwrite any existing .tga files? (y/n): ").lower()
-if overwriteTGAInput in yes:
-    OVERWRITE_TGA = True
-elif overwriteTGAInput in no:
-    OVERWRITE_TGA = False
-elif overwriteTGAInput == "": # debug: casey's favorite default value
-    OVERWRITE_TGA = False
-else:
-    print("Please respond with 'yes' or 'no.' Quitting process!")
-    quit()
-
-'''convertInput = input("Would you like to convert .vtf files to .tga? (y/n): ").lower()
-if convertInput in yes:
-    convertVTFs = True
-elif convertInput in no:
-    convertVTFs = False
-elif convertInput == "": # debug: casey's favorite default value
-    convertVTFs = False
-else:
-    print("Please respond with 'yes' or 'no.' Quitting process!")
-    quit()'''
-
-SHADER = input("What is your target shader? Valid Options: vr_complex (vr_standard support coming soon) - ").lower()
-if SHADER == "":
-    SHADER = "vr_complex"
-elif SHADER not in validS2Shaders:
-    print("Please respond with a valid shader! Quitting process!")
-    quit()
-
-# Verify file paths
-fileList = []
-vtfList = []
-
-# HACK; See note under PBR_HACK
-if SHADER.lower() == "vr_complex":
-    PBR_HACK = True
-
-# TODO: make this work so that when parsing directories, skip tools/debug stuff
-foldersToSkip = [
-    "materials\\tools",
-    "materials\\debug"
-]
-
-if(targetFolder):
-    absFilePath = os.path.abspath(targetFolder)
-    if os.path.isdir(absFilePath):
-        fileList.extend(parseDir(absFilePath))
-    elif(absFilePath.lower().endswith('.vmt')):
-        fileList.append(absFilePath)
-    elif(absFilePath.lower().endswith('.vtf')):
-        vtfList.append(absFilePath)
-    else:
-        print('ERROR: File path is invalid. required format: "vmt_to_vmat.py C:\\path\\to\\folder_or_vmt"')
-        quit()
-else:
-    print('ERROR: CMD Arguments are invalid. Required format: "vmt_to_vmat.py C:\\path\\to\\folder_or_vmt"')
-    quit()
-
-for vmtFileName in fileList:
-    print("+ Processing .vmt file: " + vmtFileName)
+def parseVMT(lines, log = print):
+    # Reads a .vmt into {"shader": name, "parameters": {key: value}, "blocks": {name: {key: value}}}, all lowercase.
+    # Sub-blocks (Proxies, the _dx9/_hdr fallbacks, a patch's insert/replace...) end up in "blocks" instead of
+    # being mixed into the material's own parameters.
+    material = {"shader": "", "parameters": {}, "blocks": {}}
+    pairs = keyvalues.parseKeyValues(lines)
+    if not pairs or not isinstance(pairs[0][1], list):
+        return material
+
+    material["shader"] = pairs[0][0].lower()
+    for key, value in pairs[0][1]:
+        key = key.lower() # we process all values and keys as lowercase
+        if isinstance(value, list):
+            if key not in material["blocks"]:
+                material["blocks"][key] = keyvalues.keyValuesToDict(value, True)
+            continue
+
+        value = value.strip().strip("'").lower()
+        if value == "":
+            log("+ WARNING: No value found in parameter " + key + ", skipping!")
+            continue
+        # So I chose this to be simple in code later, so I don't have to check if a value exists in vmtParameters AND check it's value
+        # But, this should be fine cuz .vmt seems to treat any 0 values as the default parameter. If there's a value out there though
+        # that relies on 0, we can add it here as an exception.
+        if value == "0":
+            log("+ WARNING: Value of " + key + " found to be 0, skipping!")
+            continue
+
+        # like the engine, the first one wins if a parameter shows up twice
+        if key not in material["parameters"]:
+            material["parameters"][key] = value
+            # reports back as dict with the format $basetexture models/alyx/alyx_faceandhair
+    return material
+
+def convertMaterial(vmtFileName, settings, force = False):
+    # Converts a single .vmt to .vmat. This runs inside the worker processes, so it must not touch any globals
+    # set up by main() and everything it wants to print goes into the returned MaterialResult instead.
+    # force rewrites everything no matter the overwrite settings, used when the manifest says the inputs changed.
+    # The time that isn't in any of the phases below (see timed()) goes to "other".
+    global currentResult
+    result = MaterialResult(vmtFileName, settings.overwriteTga or force, settings.runStartTime)
+    currentResult = result
+    try:
+        with timed("other"):
+            writeMaterial(vmtFileName, settings, force, result)
+    except TextureError as error:
+        result.log("- ERROR: " + error.fileName + " could not be read (" + error.reason + "). Skipping!")
+        result.status = "error"
+        removePartialVmat(result)
+    except ValueError as error:
+        # a parameter that isn't the number or vector it should be, i.e. $selfillumtint "[1 x 1]"
+        result.log("- ERROR: Badly formatted parameter in " + os.path.basename(vmtFileName) + " (" + str(error) + "). Skipping!")
+        result.status = "error"
+        removePartialVmat(result)
+    finally:
+        currentResult = None
+    return result
+
+def removePartialVmat(result):
+    # A material that failed halfway through writing its .vmat shouldn't leave the half it wrote behind
+    if result.vmatFileName in result.outputs and os.path.exists(result.vmatFileName):
+        os.remove(result.vmatFileName)
+
+def writeMaterial(vmtFileName, settings, force, result):
+    # The conversion itself, logged to result
+    result.log("+ Processing .vmt file: " + vmtFileName)
     baseFileName  = os.path.basename(vmtFileName.replace('.vmt', ''))
-    if modPath == "":
-        modPath = vmtFileName.split('materials')[0]
-    vmtParameters = {}
-    vmtShader = ""
-
+    modPath = vmtFileName.split('materials')[0]
     vmatFileName = addFolderExtension(vmtFileName).replace('.vmt', '.vmat')
-    if os.path.exists(vmatFileName) and not OVERWRITE_VMAT:
-        print('+ WARNING: File already exists. Skipping!')
-        continue
+    result.vmatFileName = vmatFileName
+    if os.path.exists(vmatFileName) and not (settings.overwriteVmat or force):
+        result.log('+ WARNING: File already exists. Skipping!')
+        return
 
     basePath = 'materials' + vmtFileName.split('materials', 1)[1].replace('.vmt', '')
 
-    with open(vmtFileName, 'r') as vmtFile:
-        for line in vmtFile.readlines():
-            if parseLine(line) in vmtSupportedShaders:
-                vmtShader = parseLine(line)
-            else:
-                parseVMTParameter(line, vmtParameters)
+    with timed("parse"):
+        material, materialFiles = getMaterialStore().resolve(vmtFileName, modPath, result.log)
+    for materialFile in materialFiles:
+        result.inputs[materialFile] = fileSignature(materialFile)
+    vmtParameters = material["parameters"]
+
+    for texturePath in getTexturePaths(vmtParameters, modPath):
+        result.inputs[texturePath] = fileSignature(texturePath)
 
-        if vmtShader == "": # vmt shader not supported
-            print("- ERROR: Unsupported shader in " + baseFileName + ". Skipping!")
-            if debugPauseOnError:
-                input("Press the <ENTER> key to continue...")
-            continue #skip!
+    if material["shader"] not in vmtSupportedShaders: # vmt shader not supported
+        result.log("- ERROR: Unsupported shader in " + baseFileName + ". Skipping!")
+        result.status = "error"
+        return #skip!
 
-    print('+ Parsing ' + os.path.basename(vmtFileName))
+    result.log('+ Parsing ' + os.path.basename(vmtFileName))
+    os.makedirs(os.path.dirname(vmatFileName), exist_ok=True)
     
     # default image, to later check if we actually found something 
     nullImage = Image.new("RGB", (4, 4))
@@ -401,147 +963,228 @@ for vmtFileName in fileList:
     maskMap = nullImage
     detailMap = nullImage
 
+    textures = getTextureCache(settings)
+
+    def getAlpha(texture):
+        # The alpha channel of texture as a map. If it has none, or it's the same all over, a small flat image of its
+        # value stands in for it instead, so the channel is never taken out (and written) for nothing.
+        alpha = textures.getAlphaInfo(texture)
+        if alpha.isFlat():
+            return Image.new("L", (4, 4), alpha.min)
+        return texture.getchannel('A')
+
     # Prep TextureColor
     if "$basetexture" in vmtParameters:
-        tgaPath = modPath + "materials\\" + parseVMTPath(vmtParameters["$basetexture"]) + ".tga"
+        textureFileName = findTexture(modPath, vmtParameters["$basetexture"])
         try:
-            baseTexture = Image.open(tgaPath)
+            baseTexture = textures.open(textureFileName, vmtParameters["$basetexture"])
             baseMap = baseTexture
 
             if "$basemapalphaphongmask" in vmtParameters:
-                phongMap = baseTexture.getchannel('A')
+                phongMap = getAlpha(baseTexture)
             if "$basemapalphaenvmapmask" in vmtParameters:
-                envMap = baseTexture.getchannel('A')
+                envMap = getAlpha(baseTexture)
             if "$selfillum" in vmtParameters and "$selfillummask" not in vmtParameters:
-                illumMap = baseTexture.getchannel('A')
+                illumMap = getAlpha(baseTexture)
             if "$translucent" in vmtParameters or "$alphatest" in vmtParameters:
-                transMap = baseTexture.getchannel('A')
+                transMap = getAlpha(baseTexture)
             if "$basealphaenvmapmask" in vmtParameters:
-                envMap = baseTexture.getchannel('A')
+                envMap = getAlpha(baseTexture)
             if "$blendtintbybasealpha" in vmtParameters:
-                maskMap = baseTexture.getchannel('A')
+                maskMap = getAlpha(baseTexture)
         except:
-            print("- ERROR: $basetexture file " + parseVMTPath(vmtParameters["$basetexture"]) + " in TGA does not exist. Skipping!")
+            result.log("- ERROR: $basetexture file " + parseVMTPath(vmtParameters["$basetexture"]) + " does not exist or could not be read. Skipping!")
 
     # Prep TextureNormal for normal/bump maps
     if "$bumpmap" in vmtParameters or "$normalmap" in vmtParameters:
         if "$bumpmap" in vmtParameters:
-            tgaPath = modPath + "materials\\" + parseVMTPath(vmtParameters["$bumpmap"]) + ".tga"
+            bumpPath = vmtParameters["$bumpmap"]
         elif "$normalmap" in vmtParameters:
-            tgaPath = modPath + "materials\\" + parseVMTPath(vmtParameters["$normalmap"]) + ".tga"
+            bumpPath = vmtParameters["$normalmap"]
+        textureFileName = findTexture(modPath, bumpPath)
 
         try:
-            bumpTexture = Image.open(tgaPath)
+            bumpTexture = textures.open(textureFileName, bumpPath)
             bumpMap = bumpTexture
             if "$basemapalphaphongmask" in vmtParameters:
-                phongMap = bumpTexture.getchannel("A")
+                phongMap = getAlpha(bumpTexture)
 
             if "$normalmapalphaenvmapmask" in vmtParameters:
-                envMap = bumpTexture.getchannel("A")
+                envMap = getAlpha(bumpTexture)
         except:
-            print("- ERROR: $bumpmap/$normalmap file " + tgaPath.split(modPath + "materials\\")[1] + " in TGA does not exist. Skipping!")
+            result.log("- ERROR: $bumpmap/$normalmap file " + parseVMTPath(bumpPath) + " does not exist or could not be read. Skipping!")
 
     if "$envmap" in vmtParameters and "$envmapmask" in vmtParameters:
-        tgaPath = modPath + "materials\\" + parseVMTPath(vmtParameters["$envmapmask"]) + ".tga"
+        textureFileName = findTexture(modPath, vmtParameters["$envmapmask"])
         try:
-            envTexture = Image.open(tgaPath)
+            envTexture = textures.open(textureFileName, vmtParameters["$envmapmask"])
             envMap = envTexture.convert("RGB")
         except:
-            print("- ERROR: $envmapmask file " + parseVMTPath(vmtParameters["$envmapmask"]) + " in TGA does not exist. Skipping!")
+            result.log("- ERROR: $envmapmask file " + parseVMTPath(vmtParameters["$envmapmask"]) + " does not exist or could not be read. Skipping!")
 
     # Prep Glossiness Map using Phong Exponent
     if "$phongexponenttexture" in vmtParameters:
-        tgaPath = modPath + "materials\\" + parseVMTPath(vmtParameters["$phongexponenttexture"]) + ".tga"
+        textureFileName = findTexture(modPath, vmtParameters["$phongexponenttexture"])
         try:
-            phongTexture = Image.open(tgaPath)
+            phongTexture = textures.open(textureFileName, vmtParameters["$phongexponenttexture"])
             phongExpMap = phongTexture
         except:
-            print("- ERROR: $phongexponenttexture file " + parseVMTPath(vmtParameters["$phongexponenttexture"]) + " in TGA does not exist. Skipping!")
+            result.log("- ERROR: $phongexponenttexture file " + parseVMTPath(vmtParameters["$phongexponenttexture"]) + " does not exist or could not be read. Skipping!")
 
     # Prep TextureSelfIllum using selfillum stuff
     if "$selfillum" in vmtParameters and "$selfillummask" in vmtParameters:
-        tgaPath = modPath + "materials\\" + parseVMTPath(vmtParameters["$selfillummask"]) + ".tga"
+        textureFileName = findTexture(modPath, vmtParameters["$selfillummask"])
         try:
-            illumTexture = Image.open(tgaPath)
+            illumTexture = textures.open(textureFileName, vmtParameters["$selfillummask"])
             illumMap = illumTexture
         except:
-            print("- ERROR: $selfillummask file " + parseVMTPath(vmtParameters["$selfillummask"]) + " in TGA does not exist. Skipping!")
+            result.log("- ERROR: $selfillummask file " + parseVMTPath(vmtParameters["$selfillummask"]) + " does not exist or could not be read. Skipping!")
 
     # Rarely used, but ambient occlusion maps are sometimes available
     if "$ambientoccltexture" in vmtParameters or "$ambientocclusiontexture" in vmtParameters:
         if "$ambientoccltexture" in vmtParameters:
-            tgaPath = modPath + "materials\\" + vmtParameters["$ambientoccltexture"] + ".tga"
+            aoPath = vmtParameters["$ambientoccltexture"]
         elif "$ambientocclusiontexture" in vmtParameters:
-            tgaPath = modPath + "materials\\" + vmtParameters["$ambientocclusiontexture"] + ".tga"
+            aoPath = vmtParameters["$ambientocclusiontexture"]
+        textureFileName = findTexture(modPath, aoPath)
         try:
-            aoTexture = Image.open(tgaPath)
+            aoTexture = textures.open(textureFileName, aoPath)
             aoMap = aoTexture
         except:
-            print("- ERROR: $ambientoccltexture/$ambientocclusiontexture file " + tgaPath.split(modPath + "materials\\")[1] + " in TGA does not exist. Skipping!")
+            result.log("- ERROR: $ambientoccltexture/$ambientocclusiontexture file " + parseVMTPath(aoPath) + " does not exist or could not be read. Skipping!")
+
+    def getOutputTexture(image, suffix, transform = "", shareable = True):
+        # Returns the file to write one of this material's maps to, the path the .vmat should use for it and whether
+        # it's shared. Shared maps are named after the texture they came from and what was done to it: X for X as is,
+        # X_alpha for its alpha channel (the "L" conversions done to those don't change anything) and X + transform
+        # for everything else (X_normal for X as a normal map), so every material deriving the same map uses the same
+        # file.
+        if settings.shareDerivedTextures and shareable and 'source' in image.info:
+            texturePath, channel = image.info['source']
+            if channel == 'A':
+                texturePath += '_alpha'
+            else:
+                texturePath += transform
+            # maps written smaller than the texture (see MAX_TEXTURE_SIZE) also get the size they're written at
+            level = image.getLevel(settings.maxTextureSize.get(suffix[1:], 0))
+            if level > 0:
+                texturePath += '_' + str(max(image.getMipSize(level)))
+            return addFolderExtension(getMaterialsFilePath(modPath, texturePath) + settings.textureFileExt), 'materials/' + texturePath + settings.textureFileExt, True
+        return vmatFileName.replace('.vmat', suffix + settings.textureFileExt), basePath + suffix + settings.textureFileExt, False
+
+    def loadMap(image, suffix, mode = None):
+        # Decodes a map we only have a TextureHandle for, no bigger than the maximum size for its type, and converts
+        # it to mode unless it's in that mode already (the alpha channels we pull out already are "L")
+        if mode is not None and image.mode != mode:
+            image = image.convert(mode)
+        if isinstance(image, TextureHandle):
+            return image.load(settings.maxTextureSize.get(suffix[1:], 0))
+        return image
+
+    def getConstant(image, suffix, mode = None, flip = False):
+        # What to put in the .vmat instead of a map that's the same colour all over (see formatConstant()), so no
+        # texture has to be written or compiled for it. None if the map isn't flat.
+        image = loadMap(image, suffix, mode)
+        with timed("analysis"):
+            values = getFlatColor(image)
+        if values is None:
+            return None
+        value = formatConstant(values, flip)
+        result.log("+ " + baseFileName + suffix + " is flat, using " + value + " instead of a texture")
+        return value
+
+    def writeMap(image, suffix, fileName, shared, mode = None):
+        # saveTexture(loadMap(...)), except that a map that would come out the same as the file it's read from (a .tga
+        # written as .tga at full size, without taking a channel out or converting it) is copied byte for byte instead
+        # of being decoded and encoded again
+        if (isinstance(image, TextureHandle) and image.vtfFile is None and image.channel is None
+                and image.convertMode in (None, image.textureMode) and mode in (None, image.textureMode)
+                and image.getLevel(settings.maxTextureSize.get(suffix[1:], 0)) == 0
+                and os.path.splitext(image.fileName)[1].lower() == os.path.splitext(fileName)[1].lower()):
+            copyOnce(image.fileName, fileName)
+        else:
+            saveTexture(loadMap(image, suffix, mode), fileName, shared)
 
-    if SHADER == "vr_complex":
-        print('+ Creating ' + os.path.basename(vmatFileName))
-        with open(vmatFileName, 'w') as vmatFile:
+    if settings.shader == "vr_complex":
+        result.log('+ Creating ' + os.path.basename(vmatFileName))
+        result.outputs.append(vmatFileName)
+        with timed("vmat_write"), open(vmatFileName, 'w') as vmatFile:
             # VMT Maps are now parsed. Moving onto creating the vmat!
             vmatFile.write('// Converted with vmt_to_vmat.py\n\n')
-            vmatFile.write('Layer0\n{\n\tshader "' + SHADER + '.vfx"\n\n')
+            vmatFile.write('Layer0\n{\n\tshader "' + settings.shader + '.vfx"\n\n')
 
             # move onto writing materials if they exist
             # Prep TextureColor
             if 'is_null' not in baseMap.info:
-                if not OVERWRITE_TGA or OVERWRITE_TGA and not os.path.exists(vmatFileName.replace('.vmat', '_color.tga')):
-                    #baseMap.save(vmatFileName.replace('.vmat', '_color.tga'))
-                    baseMap.save(vmatFileName.replace('.vmat', '_color.tga'))
-                    print(os.path.basename(vmatFileName.replace('.vmat', '_color.tga')) + " saved!")
-                vmatFile.write('\tTextureColor "' + basePath + '_color.tga' + '"\n')
+                colorFileName, colorPath, shared = getOutputTexture(baseMap, '_color')
+                if result.claimOutput(colorFileName, shared):
+                    writeMap(baseMap, '_color', colorFileName, shared)
+                    result.log(os.path.basename(colorFileName) + " saved!")
+                vmatFile.write('\tTextureColor "' + colorPath + '"\n')
 
             # Prep TextureNormal for normal/bump maps
             if 'is_null' not in bumpMap.info:
                 if "$ssbump" in vmtParameters and "1" in vmtParameters["$ssbump"]:
-                    print("- WARNING: " + os.path.basename(vmtFileName) + " uses $ssbump, which is not supported in Source 2. Skipping normal maps.")
+                    result.log("- WARNING: " + os.path.basename(vmtFileName) + " uses $ssbump, which is not supported in Source 2. Skipping normal maps.")
                     vmatFile.write('\t// $ssbump in original .vmt used, which are unsupported in Source 2. Normal maps skipped to retain visual quality.\n')
                 else:
-                    if not OVERWRITE_TGA or OVERWRITE_TGA and not os.path.exists(vmatFileName.replace('.vmat', '_normal.tga')):
-                        bumpMap.save(vmatFileName.replace('.vmat', '_normal.tga'))
-                        print(os.path.basename(vmatFileName.replace('.vmat', '_normal.tga')) + " saved!")
+                    # named apart from the shared _color of the same texture, the settings file below only goes with this one
+                    normalFileName, normalPath, shared = getOutputTexture(bumpMap, '_normal', '_normal')
+                    if result.claimOutput(normalFileName, shared):
+                        writeMap(bumpMap, '_normal', normalFileName, shared)
+                        result.log(os.path.basename(normalFileName) + " saved!")
                     # For normal maps, we produce a file called fileName.txt that tells Source 2 to flip the green channel
-                    bumpSettingsFileName = vmatFileName.replace(".vmat", "_normal.txt")
-                    with open(bumpSettingsFileName, 'w') as bumpSettings:
-                        bumpSettings.write('"settings"\n'
-                                           '{\n'
-                                           '\t"legacy_source1_inverted_normal"\t"1"\n'
-                                           '}')
-                    vmatFile.write('\tTextureNormal "' + basePath + '_normal.tga' + '"\n')
+                    bumpSettingsFileName = os.path.splitext(normalFileName)[0] + ".txt"
+                    if result.claimOutput(bumpSettingsFileName, shared):
+                        writeTextOnce(bumpSettingsFileName, '"settings"\n'
+                                                            '{\n'
+                                                            '\t"legacy_source1_inverted_normal"\t"1"\n'
+                                                            '}')
+                    vmatFile.write('\tTextureNormal "' + normalPath + '"\n')
             
             # Rarely used, but ambient occlusion maps are sometimes available
             # However, since we use a hack in vr_complex for phong masks, we prioritize that over custom AO textures
             if 'is_null' not in phongMap.info:
-                if not OVERWRITE_TGA or OVERWRITE_TGA and not os.path.exists(vmatFileName.replace('.vmat', '_ao.tga')):
-                    phongMap.save(vmatFileName.replace('.vmat', '_ao.tga'))
-                    print(os.path.basename(vmatFileName.replace('.vmat', '_ao.tga')) + " saved!")
-                if "$phongboost" in vmtParameters:
-                    # For phong boost, we scale brightness of the roughness/phong map which seems to be a 1:1 ratio
-                    aoSettingsFileName = vmatFileName.replace(".vmat", "_ao.txt")
-                    with open(aoSettingsFileName, 'w') as aoSettings:
-                        aoSettings.write('"settings"\n'
-                                           '{\n'
-                                           '\t"brightness"\t"' + vmtParameters["$phongboost"] + '"\n'
-                                           '}')
-                vmatFile.write('\tg_vReflectanceRange "[0.000 ' + str(reflRange) + ']"\n')
-                vmatFile.write('\tTextureAmbientOcclusion "' + basePath + '_ao.tga' + '"\n')
+                # with $phongboost the brightness goes in a settings file next to the texture, so it needs one
+                aoValue = getConstant(phongMap, '_ao') if "$phongboost" not in vmtParameters else None
+                if aoValue is None:
+                    # the $phongboost settings file belongs to this material, so its AO can't be shared
+                    aoFileName, aoPath, shared = getOutputTexture(phongMap, '_ao', shareable="$phongboost" not in vmtParameters)
+                    if result.claimOutput(aoFileName, shared):
+                        writeMap(phongMap, '_ao', aoFileName, shared)
+                        result.log(os.path.basename(aoFileName) + " saved!")
+                    if "$phongboost" in vmtParameters:
+                        # For phong boost, we scale brightness of the roughness/phong map which seems to be a 1:1 ratio
+                        aoSettingsFileName = os.path.splitext(aoFileName)[0] + ".txt"
+                        result.outputs.append(aoSettingsFileName)
+                        with open(aoSettingsFileName, 'w') as aoSettings:
+                            aoSettings.write('"settings"\n'
+                                               '{\n'
+                                               '\t"brightness"\t"' + vmtParameters["$phongboost"] + '"\n'
+                                               '}')
+                    aoValue = '"' + aoPath + '"'
+                vmatFile.write('\tg_vReflectanceRange "[0.000 ' + str(settings.reflRange) + ']"\n')
+                vmatFile.write('\tTextureAmbientOcclusion ' + aoValue + '\n')
                 vmatFile.write('\tg_flAmbientOcclusionDirectSpecular "1.000"\n')
             elif 'is_null' not in envMap.info: # unsure if this is the correct way to handle this, will have to see how HLA truly handles cubemaps in materials
-                if not OVERWRITE_TGA or OVERWRITE_TGA and not os.path.exists(vmatFileName.replace('.vmat', '_ao.tga')):
-                    envMap.save(vmatFileName.replace('.vmat', '_ao.tga'))
-                    print(os.path.basename(vmatFileName.replace('.vmat', '_ao.tga')) + " saved!")
-                vmatFile.write('\tTextureAmbientOcclusion "' + basePath + '_ao.tga' + '"\n')
+                aoValue = getConstant(envMap, '_ao')
+                if aoValue is None:
+                    aoFileName, aoPath, shared = getOutputTexture(envMap, '_ao', '_rgb')
+                    if result.claimOutput(aoFileName, shared):
+                        writeMap(envMap, '_ao', aoFileName, shared)
+                        result.log(os.path.basename(aoFileName) + " saved!")
+                    aoValue = '"' + aoPath + '"'
+                vmatFile.write('\tTextureAmbientOcclusion ' + aoValue + '\n')
                 vmatFile.write('\tg_flAmbientOcclusionDirectSpecular "0.000"\n')
             elif "$ambientoccltexture" in vmtParameters or "$ambientocclusiontexture" in vmtParameters:
-                if not OVERWRITE_TGA or OVERWRITE_TGA and not os.path.exists(vmatFileName.replace('.vmat', '_ao.tga')):
-                    aoMapConvert = aoMap.convert("L")
-                    aoMapConvert.save(vmatFileName.replace('.vmat', '_ao.tga'))
-                    print(os.path.basename(vmatFileName.replace('.vmat', '_ao.tga')) + " saved!")
-                vmatFile.write('\tTextureAmbientOcclusion "' + basePath + '_ao.tga' + '"\n')
+                aoValue = getConstant(aoMap, '_ao', "L")
+                if aoValue is None:
+                    aoFileName, aoPath, shared = getOutputTexture(aoMap, '_ao', '_gray')
+                    if result.claimOutput(aoFileName, shared):
+                        writeMap(aoMap, '_ao', aoFileName, shared, "L")
+                        result.log(os.path.basename(aoFileName) + " saved!")
+                    aoValue = '"' + aoPath + '"'
+                vmatFile.write('\tTextureAmbientOcclusion ' + aoValue + '\n')
             
             # This value is a guess on comparing strengths of Phong exponent.
             # https://developer.valvesoftware.com/wiki/Phong_materials
@@ -553,12 +1196,20 @@ for vmtFileName in fileList:
             if "$phong" in vmtParameters:
                 vmatFile.write('\tF_SPECULAR 1\n')
                 if 'is_null' not in phongExpMap.info:
-                    if not OVERWRITE_TGA or OVERWRITE_TGA and not os.path.exists(vmatFileName.replace('.vmat', '_rough.tga')):
-                        phongExpMapFlip = phongExpMap.convert('RGB')
-                        phongExpMapFlip = PIL.ImageOps.invert(phongExpMapFlip)
-                        phongExpMapFlip.save(vmatFileName.replace('.vmat', '_rough.tga'))
-                        print(os.path.basename(vmatFileName.replace('.vmat', '_rough.tga')) + " saved!")
-                    vmatFile.write('\tTextureRoughness "' + basePath + '_rough.tga' + '"\n')
+                    # only the RGB bands end up in the roughness map, whatever the alpha holds doesn't matter
+                    roughValue = getConstant(phongExpMap, '_rough', "RGB", flip=True)
+                    if roughValue is None:
+                        roughFileName, roughPath, shared = getOutputTexture(phongExpMap, '_rough', '_rough')
+                        if result.claimOutput(roughFileName, shared):
+                            roughMap = loadMap(phongExpMap, '_rough', "RGB")
+                            with timed("map_build"):
+                                roughPacked = RGBAImage(roughMap.size, (0, 0, 0, 255))
+                                roughPacked.setRGB(roughMap, True)
+                                phongExpMapFlip = roughPacked.getImage("RGB")
+                            saveTexture(phongExpMapFlip, roughFileName, shared)
+                            result.log(os.path.basename(roughFileName) + " saved!")
+                        roughValue = '"' + roughPath + '"'
+                    vmatFile.write('\tTextureRoughness ' + roughValue + '\n')
                 elif "$phongexponent" in vmtParameters:
                     specValue = vmtParameters["$phongexponent"]
                     finalSpec = (-10642.28 + (254.2042 - -10642.28)/(1 + (float(specValue)/2402433000000)**0.1705696))/255
@@ -569,30 +1220,48 @@ for vmtFileName in fileList:
             
             # Prep TextureSelfIllum using selfillum stuff
             if "$selfillum" in vmtParameters:
-                vmatFile.write('\tF_SELF_ILLUM 1\n')
-                vmatFile.write('\tTextureSelfIllumMask "' + basePath + '_selfillum.tga' + '"\n')
-                if "$selfillumtint" in vmtParameters:
-                    vmatFile.write('\tg_vSelfIllumTint ' + fixVector(vmtParameters["$selfillumtint"]) + '\n')
-                if "$selfillummaskscale" in vmtParameters:
-                    vmatFile.write('\tg_flSelfIllumScale "' + vmtParameters['$selfillummaskscale'] + '"\n')
-                if not OVERWRITE_TGA or OVERWRITE_TGA and not os.path.exists(vmatFileName.replace('.vmat', '_selfillum.tga')):
-                    illumMapConvert = illumMap.convert("L")
-                    illumMapConvert.save(vmatFileName.replace('.vmat', '_selfillum.tga'))
-                    print(os.path.basename(vmatFileName.replace('.vmat', '_selfillum.tga')) + " saved!")
+                illumValue = getConstant(illumMap, '_selfillum', "L")
+                if illumValue == formatConstant([0]):
+                    result.log("+ " + baseFileName + "_selfillum is black, leaving out self-illum")
+                elif illumValue is None:
+                    illumFileName, illumPath, shared = getOutputTexture(illumMap, '_selfillum', '_gray')
+                    if result.claimOutput(illumFileName, shared):
+                        writeMap(illumMap, '_selfillum', illumFileName, shared, "L")
+                        result.log(os.path.basename(illumFileName) + " saved!")
+                    illumValue = '"' + illumPath + '"'
+                if illumValue != formatConstant([0]):
+                    vmatFile.write('\tF_SELF_ILLUM 1\n')
+                    vmatFile.write('\tTextureSelfIllumMask ' + illumValue + '\n')
+                    if "$selfillumtint" in vmtParameters:
+                        vmatFile.write('\tg_vSelfIllumTint ' + fixVector(vmtParameters["$selfillumtint"]) + '\n')
+                    if "$selfillummaskscale" in vmtParameters:
+                        vmatFile.write('\tg_flSelfIllumScale "' + vmtParameters['$selfillummaskscale'] + '"\n')
 
             # Prep TextureTransparancy using either alphatest or translucent
+            # The alpha of the $basetexture decides which one: neither if it's fully opaque, and alpha test rather
+            # than blending if it's only ever fully transparent or fully opaque. Materials that are see-through for
+            # other reasons ($additive, $vertexalpha, $alpha below 1) blend no matter what their alpha is.
             if "$translucent" in vmtParameters or "$alphatest" in vmtParameters:
-                if "$translucent" in vmtParameters:
-                    vmatFile.write('\tF_TRANSLUCENT 1\n')
-                elif "$alphatest" in vmtParameters:
-                    vmatFile.write('\tF_ALPHA_TEST 1\n')
-                if "$additive" in vmtParameters:
-                    vmatFile.write('\tF_ADDITIVE_BLEND 1\n')
-                if not OVERWRITE_TGA or OVERWRITE_TGA and not os.path.exists(vmatFileName.replace('.vmat', '_trans.tga')):
-                    transMapConvert = transMap.convert("L")
-                    transMapConvert.save(vmatFileName.replace('.vmat', '_trans.tga'))
-                    print(os.path.basename(vmatFileName.replace('.vmat', '_trans.tga')) + " saved!")
-                vmatFile.write('\tTextureTranslucency "' + basePath + '_trans.tga' + '"\n')
+                alpha = textures.getAlphaInfo(baseMap) if isinstance(baseMap, TextureHandle) else None
+                additive = "$additive" in vmtParameters
+                blended = additive or "$vertexalpha" in vmtParameters or float(vmtParameters.get("$alpha", "1")) < 1
+                if alpha is not None and alpha.min == 255 and not blended:
+                    result.log("+ " + baseFileName + " is fully opaque, leaving out translucency")
+                else:
+                    if "$translucent" in vmtParameters and (alpha is None or not alpha.binary or blended):
+                        vmatFile.write('\tF_TRANSLUCENT 1\n')
+                    else:
+                        vmatFile.write('\tF_ALPHA_TEST 1\n')
+                    if additive:
+                        vmatFile.write('\tF_ADDITIVE_BLEND 1\n')
+                    transValue = getConstant(transMap, '_trans', "L")
+                    if transValue is None:
+                        transFileName, transPath, shared = getOutputTexture(transMap, '_trans', '_gray')
+                        if result.claimOutput(transFileName, shared):
+                            writeMap(transMap, '_trans', transFileName, shared, "L")
+                            result.log(os.path.basename(transFileName) + " saved!")
+                        transValue = '"' + transPath + '"'
+                    vmatFile.write('\tTextureTranslucency ' + transValue + '\n')
 
             # Setting up Color Tint
             if "$color" in vmtParameters:
@@ -603,11 +1272,14 @@ for vmtFileName in fileList:
             elif "$color2" in vmtParameters:
                 # $blendtintbybasealpha does what it says on the tin, and is used by TF to tint items for team colors
                 if "$blendtintbybasealpha" in vmtParameters:
-                    if not OVERWRITE_TGA or OVERWRITE_TGA and not os.path.exists(vmatFileName.replace('.vmat', '_colormask.tga')):
-                        maskMapConvert = maskMap.convert("L")
-                        maskMapConvert.save(vmatFileName.replace('.vmat', '_colormask.tga'))
-                        print(os.path.basename(vmatFileName.replace('.vmat', '_colormask.tga')) + " saved!")
-                        vmatFile.write('\tF_TINT_MASK 1\n\tTextureTintMask "' + basePath + '_colormask.tga' + '"\n')
+                    maskValue = getConstant(maskMap, '_colormask', "L")
+                    if maskValue is None:
+                        maskFileName, maskPath, shared = getOutputTexture(maskMap, '_colormask', '_gray')
+                        if result.claimOutput(maskFileName, shared):
+                            writeMap(maskMap, '_colormask', maskFileName, shared, "L")
+                            result.log(os.path.basename(maskFileName) + " saved!")
+                        maskValue = '"' + maskPath + '"'
+                    vmatFile.write('\tF_TINT_MASK 1\n\tTextureTintMask ' + maskValue + '\n')
                 if "{" in vmtParameters["$color2"]:
                     vmatFile.write('\tg_vColorTint ' + fixVector(vmtParameters["$color2"], 255) + '\n')  # process as int
                 elif "[" in vmtParameters["$color2"]:
@@ -617,15 +1289,21 @@ for vmtFileName in fileList:
             if "$detail" in vmtParameters:
                 # Detail textures are unique since they're almost always shared with other materials,
                 # So in this case we just copy it once and then continue to process like normal
-                tgaPath = modPath + "materials\\" + parseVMTPath(vmtParameters["$detail"]) + ".tga"
-                if not os.path.exists(addFolderExtension(tgaPath)):
+                detailFileName = findTexture(modPath, vmtParameters["$detail"])
+                # .tgas are copied as they are, .vtfs written in the format of the other textures
+                detailExt = settings.textureFileExt if detailFileName.lower().endswith('.vtf') else os.path.splitext(detailFileName)[1]
+                detailTarget = addFolderExtension(os.path.splitext(detailFileName)[0] + detailExt)
+                if not os.path.exists(detailTarget):
                     try:
-                        copyfile(tgaPath, addFolderExtension(tgaPath))
-                        print("+ " + addFolderExtension(tgaPath) + " copied to target directory!")
+                        if detailFileName.lower().endswith('.vtf'):
+                            saveTexture(textures.open(detailFileName, vmtParameters["$detail"]).load(), detailTarget, True)
+                        else:
+                            copyOnce(detailFileName, detailTarget)
+                        result.log("+ " + detailTarget + " copied to target directory!")
                     except:
-                        print("- ERROR: $detail file " + parseVMTPath(vmtParameters["$detail"]) + " in TGA does not exist. Skipping!")
+                        result.log("- ERROR: $detail file " + parseVMTPath(vmtParameters["$detail"]) + " does not exist or could not be read. Skipping!")
 
-                vmatFile.write('\tTextureDetail "' + 'materials/' + parseVMTPath(vmtParameters["$detail"]) + '.tga"\n')
+                vmatFile.write('\tTextureDetail "' + 'materials/' + parseVMTPath(vmtParameters["$detail"]) + detailExt + '"\n')
                 if "$detailblendmode" in vmtParameters:
                     vmatFile.write('\tF_DETAIL_TEXTURE 2\n')  # Overlay
                 else:
@@ -636,17 +1314,306 @@ for vmtFileName in fileList:
                     vmatFile.write('\tg_flDetailBlendFactor "' + vmtParameters["$detailblendfactor"] + '"\n')
 
             vmatFile.write('}\n')
+        count("bytes_written", os.path.getsize(vmatFileName))
 
-    elif SHADER == "vr_standard":
+    elif settings.shader == "vr_standard":
         # die
-        print("die in real")
-    elif SHADER == "globallitsimple":
+        result.log("die in real")
+    elif settings.shader == "globallitsimple":
         # die 2.0
-        print("die in real for real")
-    elif SHADER == "customhero":
+        result.log("die in real for real")
+    elif settings.shader == "customhero":
         # die 3: the finale
-        print("death death death death death")
+        result.log("death death death death death")
 
-    print('+ Finished Writing ' + vmatFileName)
+    result.log('+ Finished Writing ' + vmatFileName)
+    result.status = "converted"
 
-input("Press the <ENTER> key to close...")
\ No newline at end of file
+###
+### Library Functions
+###
+# These are what other scripts (build tools, batch jobs...) should call instead of running this one. Importing this
+# file does no work, and the textures and .vmts read are cached between calls, so one long lived process converting
+# thousands of materials doesn't pay for starting up python and PIL every time.
+
+def convert_material(path, options = None):
+    # Converts one .vmt and returns its MaterialResult. Nothing is printed, the log is in result.logLines.
+    # options is a ConverterSettings (the defaults if None). The build manifest isn't used, see convert_folder.
+    settings = options or ConverterSettings()
+    if not settings.runStartTime:
+        settings = ConverterSettings(**dict(vars(settings), runStartTime=time.time()))
+    return convertMaterial(os.path.abspath(path), settings)
+
+def load_content(path, rescan = False):
+    # The AssetInventory of a folder (or a single .vmt), from the asset index in the _imported folder.
+    # rescan lists every folder again instead of trusting the index.
+    absFilePath = os.path.abspath(path)
+    if not os.path.isdir(absFilePath) and not (absFilePath.lower().endswith('.vmt') and os.path.exists(absFilePath)):
+        raise ValueError(path + " is not a folder or a .vmt file")
+    return assets.loadInventory(absFilePath, assets.getIndexFileName(absFilePath, TARGET_FOLDER_EXTENSION), rescan)
+
+def get_materials_folder(modelsPath):
+    # The materials folder that goes with a models folder (or an .mdl or .qc in one). For models that were already put
+    # in the _imported folder, the one with the .vmts the _imported materials are made from.
+    modPath = assets.splitModPath(modelsPath)
+    if modPath is None or modPath[1] != "models":
+        raise ValueError(modelsPath + " is not in a models folder")
+    modFolder = modPath[0]
+    if modFolder.lower().endswith(TARGET_FOLDER_EXTENSION):
+        modFolder = modFolder[:-len(TARGET_FOLDER_EXTENSION)]
+    return os.path.join(modFolder, "materials")
+
+def find_model_materials(modelPaths, graph, rescan = False, log = print):
+    # The .vmts in graph (an assets.DependencyGraph of a materials folder) that the models in modelPaths (models
+    # folders, .mdls or .qcs) use, in the order they're in graph. The models are added to graph. Material names come
+    # from the texture tables of the .mdls, models that only have a .qc use everything in their $cdmaterials folders.
+    for modelPath in modelPaths:
+        absModelPath = os.path.abspath(modelPath)
+        if not os.path.exists(absModelPath):
+            raise ValueError(modelPath + " is not a models folder, .mdl or .qc file")
+        models = assets.loadInventory(absModelPath, assets.getIndexFileName(absModelPath, TARGET_FOLDER_EXTENSION), rescan)
+        for fileName in models.getFiles("model"):
+            try:
+                materials = mdl_to_vmdl.get_materials(fileName)
+            except (OSError, mdl.MDLError) as error:
+                log("- ERROR: Couldn't read the materials of " + fileName + ": " + str(error))
+                continue
+            graph.addModel(graph.getName(fileName), fileName, materials["cdmaterials"], materials["textures"])
+        for fileName in models.getFiles("qc"):
+            try:
+                materials = qc_to_vmdl.get_materials(fileName)
+            except (OSError, qc.QCError) as error:
+                log("- ERROR: Couldn't read the materials of " + fileName + ": " + str(error))
+                continue
+            for model in materials["models"]:
+                graph.addModel(model if model.endswith('.mdl') else model + '.mdl', fileName, materials["cdmaterials"])
+
+    used = set()
+    for model in graph.modelFiles:
+        used.update(graph.getModelMaterials(model))
+    return [fileName for name, fileName in graph.materialFiles.items() if name in used]
+
+def convert_folder(path, options = None, jobs = 1, full = False, log = print, inventory = None, rescan = False, graph = None,
+                   only = None, stats = None):
+    # Converts every .vmt in a folder (or a single .vmt) with jobs worker processes (0 = one per CPU core) and returns
+    # the MaterialResults. Materials the build manifest says are up to date are skipped, unless full is set.
+    # Every material's log is passed to log as it's converted, in the same order no matter how many jobs there are.
+    # inventory is an AssetInventory (see assets.py) to take the .vmts from, when the folder was already walked.
+    # Otherwise it comes from load_content(path, rescan). graph is the assets.DependencyGraph of the inventory, if
+    # there is one already. It's used to convert materials that share textures one after the other.
+    # only is a list of the .vmts to convert (i.e. from find_model_materials()), the rest of the folder is left alone.
+    # stats is a ConversionStats to add the results and the time spent checking the manifest to.
+    settings = ConverterSettings(**vars(options)) if options else ConverterSettings()
+    absFilePath = os.path.abspath(path)
+    if inventory is None:
+        inventory = load_content(absFilePath, rescan)
+    if graph is None:
+        graph = assets.DependencyGraph(inventory)
+    fileList = inventory.getFiles("material", absFilePath)
+    if only is not None:
+        only = set(only)
+        fileList = [vmtFileName for vmtFileName in fileList if vmtFileName in only]
+    fileList = graph.groupMaterialFiles(fileList)
+    if not fileList:
+        log("+ No .vmt files found!")
+        return []
+
+    # Check the manifest up front, it's just stat calls unless something was touched
+    manifestStart = time.perf_counter()
+    manifest = BuildManifest(getManifestFileName(fileList[0]))
+    settingsKey = settings.manifestKey()
+    staleFiles = []
+    staleForce = []
+    for vmtFileName in fileList:
+        if not full and manifest.isUpToDate(vmtFileName, settingsKey):
+            continue
+        staleFiles.append(vmtFileName)
+        # we built this one before and something changed, so whatever is in _imported is out of date
+        staleForce.append(not full and manifest.hasEntry(vmtFileName))
+    if len(staleFiles) < len(fileList):
+        log("+ " + str(len(fileList) - len(staleFiles)) + " materials are up to date. Skipping!")
+    if stats is not None:
+        stats.addPhase("manifest", time.perf_counter() - manifestStart)
+        stats.jobs = jobs if jobs > 0 else os.cpu_count()
+
+    results = []
+    settings.runStartTime = time.time()
+    try:
+        jobs = jobs if jobs > 0 else os.cpu_count()
+        if jobs > 1 and len(staleFiles) > 1:
+            # Workers only return their log, which is logged here in fileList order so the output stays the same
+            # as a single process run no matter which worker finishes first. Each worker gets 8 materials in a row,
+            # which groupMaterialFiles() made sure are mostly ones sharing textures.
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                for result in executor.map(convertMaterial, staleFiles, repeat(settings), staleForce, chunksize=8):
+                    result.printLog(log)
+                    manifest.update(result, settingsKey)
+                    results.append(result)
+                    if stats is not None:
+                        stats.add(result)
+        else:
+            for vmtFileName, force in zip(staleFiles, staleForce):
+                result = convertMaterial(vmtFileName, settings, force)
+                result.printLog(log)
+                manifest.update(result, settingsKey)
+                results.append(result)
+                if stats is not None:
+                    stats.add(result)
+                if result.status == "error" and debugPauseOnError:
+                    input("Press the <ENTER> key to continue...")
+    finally:
+        # save whatever got done, so an interrupted run picks up where it left off
+        manifest.save()
+    return results
+
+###
+### Main Execution
+###
+
+def askYesNo(question, default):
+    answer = input(question).lower()
+    if answer in {'yes', 'y', 'ye'}:
+        return True
+    elif answer in {'no', 'n'}:
+        return False
+    elif answer == "": # debug: casey's favorite default value
+        return default
+    print("Please respond with 'yes' or 'no.' Quitting process!")
+    quit()
+
+def main():
+
+    print('--------------------------------------------------------------------------------------------------------\n'
+          'Source 2 Material Conveter! By Rectus via Github.\nInitially forked by Alpyne, this version by caseytube.\n'
+          '--------------------------------------------------------------------------------------------------------\n')
+    print(" + Textures are read straight from your .vtfs, no need to convert them to .tga first! + \n")
+    validS2Shaders = ['vr_complex', 'vr_standard']
+    argParser = argparse.ArgumentParser(description='Converts Source 1 .vmt materials to Source 2 .vmat materials. '
+                                        'Asks for the folder and settings if no path is given.')
+    argParser.add_argument('path', nargs='?',
+                           help='materials folder or .vmt to convert. Nothing is asked for when this is given')
+    argParser.add_argument('--shader', choices=validS2Shaders, help='target shader (default: vr_complex)')
+    argParser.add_argument('--keep-vmats', action='store_true', help="don't overwrite .vmat files that already exist")
+    argParser.add_argument('--overwrite-textures', action='store_true', help='overwrite texture files that already exist')
+    argParser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of worker processes to convert materials with (0 = one per CPU core)')
+    argParser.add_argument('--texture-cache', type=int, default=TEXTURE_CACHE_MB, metavar='MB',
+                           help='memory each process may use to keep decoded textures for reuse (0 = off)')
+    argParser.add_argument('--share-textures', action='store_true', default=SHARE_DERIVED_TEXTURES,
+                           help='write maps derived from the same texture once and point every .vmat at that file')
+    argParser.add_argument('--texture-format', choices=[extension[1:] for extension in textureFormats],
+                           default=TEXTURE_FILEEXT[1:], help='file format to write textures in (default: ' + TEXTURE_FILEEXT[1:] + ')')
+    argParser.add_argument('--max-size', action='append', default=[], metavar='MAP=PIXELS',
+                           help='largest size to write a type of map at (' + ', '.join(textureMapTypes) + '), '
+                                'i.e. --max-size selfillum=1024. Can be given more than once')
+    argParser.add_argument('--full', action='store_true',
+                           help="ignore the build manifest and convert every material, even if nothing changed")
+    argParser.add_argument('--rescan', action='store_true',
+                           help="ignore the asset index and look for .vmts in every folder, even unchanged ones")
+    argParser.add_argument('--models', action='append', default=[], metavar='PATH',
+                           help='only convert the materials the models in PATH (a models folder, .mdl or .qc) use, '
+                                'PATH can be given more than once. The materials folder next to it is used if no path is given')
+    argParser.add_argument('--graph', metavar='FILE',
+                           help='also write which textures every material uses (and the other way around) to FILE as JSON')
+    argParser.add_argument('--stats', action='store_true',
+                           help='print how long every phase (parsing, reading, decoding, writing...) took and how much was read and written')
+    argParser.add_argument('--trace', metavar='FILE',
+                           help='write the time of every phase and the counters of every material to FILE, as CSV if it ends in .csv and JSON otherwise')
+    argParser.add_argument('--profile', metavar='FILE',
+                           help='run the conversion under cProfile and save the profile to FILE. Worker processes are not '
+                                'profiled, use it with -j 1')
+    args = argParser.parse_args()
+
+    maxTextureSize = dict(MAX_TEXTURE_SIZE)
+    for maxSizeArg in args.max_size:
+        mapType, _, pixels = maxSizeArg.partition('=')
+        if mapType not in textureMapTypes or not pixels.isdigit():
+            argParser.error("--max-size should look like MAP=PIXELS, with MAP one of: " + ', '.join(textureMapTypes))
+        maxTextureSize[mapType] = int(pixels)
+
+    settings = ConverterSettings(shader=args.shader or "vr_complex", overwriteVmat=not args.keep_vmats,
+                                 overwriteTga=args.overwrite_textures)
+    interactive = args.path is None and not args.models
+    if interactive:
+        # Start by asking some basic questions
+        targetFolder = input("What folder would you like to convert? Valid Format: C:\\Steam\\steamapps\\Half-Life Alyx\\content\\tf\\materials: ").lower()
+        if not os.path.exists(targetFolder):
+            print("Please respond with a valid folder or file path! Quitting Process!")
+            quit()
+
+        settings.overwriteVmat = askYesNo("Would you like to overwrite any existing .vmat files? (y/n): ", True)
+        settings.overwriteTga = askYesNo("Would you like to overwrite any existing .tga files? (y/n): ", False)
+
+        if args.shader is None:
+            settings.shader = input("What is your target shader? Valid Options: vr_complex (vr_standard support coming soon) - ").lower()
+            if settings.shader == "":
+                settings.shader = "vr_complex"
+            elif settings.shader not in validS2Shaders:
+                print("Please respond with a valid shader! Quitting process!")
+                quit()
+    else:
+        targetFolder = args.path
+        if targetFolder is None:
+            try:
+                targetFolder = get_materials_folder(os.path.abspath(args.models[0]))
+            except ValueError as error:
+                argParser.error(str(error))
+
+    # HACK; See note under PBR_HACK
+    if settings.shader.lower() == "vr_complex":
+        settings.pbrHack = True
+    settings.textureCacheMB = args.texture_cache
+    settings.shareDerivedTextures = args.share_textures
+    settings.maxTextureSize = maxTextureSize
+    settings.textureFileExt = '.' + args.texture_format
+
+    # TODO: make this work so that when parsing directories, skip tools/debug stuff
+    foldersToSkip = [
+        "materials\\tools",
+        "materials\\debug"
+    ]
+
+    stats = ConversionStats() if args.stats or args.trace else None
+    profiler = cProfile.Profile() if args.profile else None
+    runStart = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        # Only the paths are checked here, materials that fail to convert are reported in their own log
+        try:
+            inventory = load_content(targetFolder, args.rescan)
+            graph = assets.DependencyGraph(inventory)
+            only = find_model_materials(args.models, graph, args.rescan) if args.models else None
+        except ValueError:
+            print('ERROR: File path is invalid. required format: "vmt_to_vmat.py C:\\path\\to\\folder_or_vmt"')
+            if not interactive:
+                sys.exit(2)
+            quit()
+        if only is not None:
+            print("+ The models use " + str(len(only)) + " of the " + str(len(graph.materialFiles)) + " materials.")
+        if args.graph:
+            graph.save(args.graph)
+        if stats is not None:
+            stats.addPhase("walk", time.perf_counter() - runStart)
+        convert_folder(targetFolder, settings, args.jobs, args.full, inventory=inventory, graph=graph, only=only, stats=stats)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+    if stats is not None:
+        stats.wallTime = time.perf_counter() - runStart
+        if args.stats:
+            print(stats.formatTable())
+        if args.trace:
+            stats.writeTrace(args.trace)
+            print("+ Trace written to " + args.trace)
+    if profiler is not None:
+        print("+ Profile written to " + args.profile + ", the functions that took longest:")
+        pstats.Stats(args.profile).sort_stats("cumulative").print_stats(15)
+
+    if interactive:
+        input("Press the <ENTER> key to close...")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# Reads Valve Texture Format (.vtf) files straight into PIL images, so materials can be converted without first
+# running VTFEdit's "Convert Folder" over everything.
+#
+# Opening a VTFFile only reads the header. Pixels are read (with a seek to just the mip level asked for, never the
+# whole file) and decoded when getImage() is called. Only the first frame, face and depth slice is ever read.
+# DXT1/3/5 are decoded with PIL's BCn decoder and the uncompressed formats with its raw unpackers.
+
+import struct
+
+from PIL import Image
+
+VTF_SIGNATURE = b'VTF\0'
+
+TEXTUREFLAGS_ONEBITALPHA = 0x1000
+TEXTUREFLAGS_EIGHTBITALPHA = 0x2000
+TEXTUREFLAGS_ENVMAP = 0x4000
+
+# Resource tags of 7.3+ files
+RESOURCE_LOWRES_IMAGE = b'\x01\0\0'
+RESOURCE_HIGHRES_IMAGE = b'\x30\0\0'
+
+IMAGE_FORMAT_NONE = 0xFFFFFFFF
+
+# IMAGE_FORMAT: (name, bytes per pixel or DXT block, is DXT, PIL mode, PIL decoder, decoder args)
+# The 16 bit formats follow the D3D formats Source maps them to (BGR565 is D3DFMT_R5G6B5 and so on).
+imageFormats = {
+    0: ("RGBA8888", 4, False, "RGBA", "raw", "RGBA"),
+    1: ("ABGR8888", 4, False, "RGBA", "raw", "ABGR"),
+    2: ("RGB888", 3, False, "RGB", "raw", "RGB"),
+    3: ("BGR888", 3, False, "RGB", "raw", "BGR"),
+    4: ("RGB565", 2, False, "RGB", "raw", "RGB;16"),
+    5: ("I8", 1, False, "L", "raw", "L"),
+    6: ("IA88", 2, False, "LA", "raw", "LA"),
+    8: ("A8", 1, False, "A", "raw", "L"),
+    9: ("RGB888_BLUESCREEN", 3, False, "RGB", "raw", "RGB"),
+    10: ("BGR888_BLUESCREEN", 3, False, "RGB", "raw", "BGR"),
+    11: ("ARGB8888", 4, False, "RGBA", "raw", "ARGB"),
+    12: ("BGRA8888", 4, False, "RGBA", "raw", "BGRA"),
+    13: ("DXT1", 8, True, "RGBA", "bcn", 1),
+    14: ("DXT3", 16, True, "RGBA", "bcn", 2),
+    15: ("DXT5", 16, True, "RGBA", "bcn", 3),
+    16: ("BGRX8888", 4, False, "RGB", "raw", "BGRX"),
+    17: ("BGR565", 2, False, "RGB", "raw", "BGR;16"),
+    18: ("BGRX5551", 2, False, "RGB", "raw", "BGR;15"),
+    20: ("DXT1_ONEBITALPHA", 8, True, "RGBA", "bcn", 1),
+    21: ("BGRA5551", 2, False, "RGBA", "raw", "BGRA;15"),
+}
+
+class VTFError(Exception):
+    pass
+
+def getImageDataSize(imageFormat, width, height):
+    name, size, isDXT, mode, decoder, args = imageFormats[imageFormat]
+    if isDXT:
+        return max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * size
+    return width * height * size
+
+class VTFFile:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as f:
+            header = f.read(80)
+            if len(header) < 64 or header[:4] != VTF_SIGNATURE:
+                raise VTFError(fileName + " is not a VTF file")
+
+            self.version = struct.unpack_from('<2I', header, 4)
+            self.headerSize, self.width, self.height, self.flags, self.frames, self.firstFrame = struct.unpack_from('<I2HI2H', header, 12)
+            self.reflectivity = struct.unpack_from('<3f', header, 32)
+            self.bumpmapScale, self.format, self.mipCount, self.lowResFormat, self.lowResWidth, self.lowResHeight = struct.unpack_from('<fIBIBB', header, 48)
+            self.depth = 1
+            if self.version >= (7, 2):
+                self.depth = max(1, struct.unpack_from('<H', header, 63)[0])
+
+            if self.format not in imageFormats:
+                raise VTFError(fileName + " uses image format " + str(self.format) + ", which isn't supported")
+
+            if self.version >= (7, 3):
+                resourceCount = struct.unpack_from('<I', header, 68)[0]
+                resources = f.read(resourceCount * 8)
+                self.dataOffset = None
+                for i in range(resourceCount):
+                    tag, resourceFlags, offset = struct.unpack_from('<3sBI', resources, i * 8)
+                    if tag == RESOURCE_HIGHRES_IMAGE:
+                        self.dataOffset = offset
+                if self.dataOffset is None:
+                    raise VTFError(fileName + " has no image data")
+            else:
+                lowResSize = 0
+                if self.lowResFormat != IMAGE_FORMAT_NONE and self.lowResWidth and self.lowResHeight:
+                    lowResSize = getImageDataSize(self.lowResFormat, self.lowResWidth, self.lowResHeight)
+                self.dataOffset = self.headerSize + lowResSize
+
+        self.faces = 1
+        if self.flags & TEXTUREFLAGS_ENVMAP:
+            # Before 7.5, cubemaps carry a seventh spheremap face unless firstFrame is -1
+            self.faces = 7 if self.version < (7, 5) and self.firstFrame != 0xFFFF else 6
+        self.mipCount = max(1, self.mipCount)
+        self.frames = max(1, self.frames)
+        # PIL mode of the images getImage() returns
+        self.mode = imageFormats[self.format][3]
+        if self.mode == "A":
+            self.mode = "RGBA"
+
+    def hasAlpha(self):
+        # Whether the texture has an alpha channel worth reading. Plain DXT1 always decodes to RGBA, but vtex only
+        # gives it a (one bit) alpha when the source had one and flags the texture when it does.
+        if "A" not in self.mode:
+            return False
+        if imageFormats[self.format][0] == "DXT1":
+            return bool(self.flags & (TEXTUREFLAGS_ONEBITALPHA | TEXTUREFLAGS_EIGHTBITALPHA))
+        return True
+
+    def getMipSize(self, level):
+        return max(1, self.width >> level), max(1, self.height >> level)
+
+    def getMipOffset(self, level):
+        # Mips are stored smallest first, each one holding every frame, face and depth slice
+        offset = self.dataOffset
+        for mip in range(self.mipCount - 1, level, -1):
+            width, height = self.getMipSize(mip)
+            offset += getImageDataSize(self.format, width, height) * self.frames * self.faces * max(1, self.depth >> mip)
+        return offset
+
+    def getImage(self, level = 0):
+        # Decodes one mip level (0 is full size) of the first frame/face/slice
+        level = min(max(0, level), self.mipCount - 1)
+        width, height = self.getMipSize(level)
+        size = getImageDataSize(self.format, width, height)
+        with open(self.fileName, 'rb') as f:
+            f.seek(self.getMipOffset(level))
+            data = f.read(size)
+        if len(data) < size:
+            raise VTFError(self.fileName + " is truncated")
+
+        name, pixelSize, isDXT, mode, decoder, args = imageFormats[self.format]
+        if mode == "A":
+            # alpha only, make it white so it still works as a colour texture
+            alpha = Image.frombytes("L", (width, height), data, decoder, args)
+            return Image.merge("RGBA", (Image.new("L", (width, height), 255),) * 3 + (alpha,))
+        return Image.frombytes(mode, (width, height), data, decoder, args)
@@ -1,43 +1,264 @@
 # cmd command: python vmf_convert.py "C:\path\to\vmf\file.vmf"
+#
+# Streams a .vmf through a set of per-key transforms and writes the result as fileConverted.vmf. The map is read,
+# transformed and written one line at a time, so even maps of hundreds of MB never have to fit in memory.
+# By default texture scales are made 32 times bigger and every material is swapped for its .vmat in the _imported
+# materials folder of the mod the .vmf is in (--materials to use another one).
+#
+# With more than one job, the map is cut into chunks of whole solids and entities, which are converted by that many
+# worker processes and written back in order.
+#
+# i.e.: convertVMF("map.vmf", "mapConverted.vmf", {"uaxis": partial(scaleTextureAxis, 32), "vaxis": partial(scaleTextureAxis, 32)})
 
-import re, sys, os
+import re, sys, os, io, argparse
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import keyvalues
+import assets
 
 INPUT_FILE_EXT = '.vmf'
 # this leads to the root of the game folder, i.e. dota 2 beta/content/dota_addons/, make sure to remember the final slash!!
 PATH_TO_GAME_CONTENT_ROOT = ""
 PATH_TO_CONTENT_ROOT = ""
-    
-print('Source 2 .vmf Prepper! EXPERIMENTAL!! By caseytube via Github')
-print('Converts .vmf files to be ready for Source 2 by fixing materials')
-print('--------------------------------------------------------------------------------------------------------')
-
-filename = sys.argv[1]
-convertedFilename = filename.replace('.vmf', '') + 'Converted.vmf'
-if not os.path.exists(filename):
-    print("input file doesn't exist")
-    quit()
-
-print('Importing', os.path.basename(filename))
-
-with open(convertedFilename, 'w') as convFile:
-    with open(filename, 'r') as vmfFile:
-        for line in vmfFile.readlines():
-            splitLine = line.replace('"', '').replace("'", "").split()
-            last = len(splitLine) - 1
-            
-            if "uaxis" in line:
-                oldVar = splitLine[last]
-                print(oldVar)
-                newVar = float(oldVar) * 32
-                print(newVar)
-                newLine = line.replace(str(oldVar), str(newVar))
-                convFile.write(newLine)
-            elif "vaxis" in line:
-                oldVar = splitLine[last]
-                print(oldVar)
-                newVar = float(oldVar) * 32
-                print(newVar)
-                newLine = line.replace(str(oldVar), str(newVar))
-                convFile.write(newLine)
+# Source 2 wants texture scales this many times bigger than Hammer's
+TEXTURE_SCALE = 32
+# Same as in vmt_to_vmat.py, the folder the converted materials are in is the mod's with this added
+TARGET_FOLDER_EXTENSION = '_imported'
+# Lines per chunk when converting with more than one job. Chunks only end after a whole solid or entity, so they can
+# be a bit longer.
+CHUNK_LINES = 50000
+
+# Event kinds readVMF() yields
+BLOCK = 0   # (BLOCK, name): a block starts
+KEY = 1     # (KEY, key, value)
+END = 2     # (END,): the last block that started ends
+
+# How Hammer writes nearly every line: a "key" "value" pair, a block name, or a brace. Anything else goes through
+# keyvalues.tokenize()
+linePattern = re.compile(r'^\s*(?:"([^"\n]*)"\s+"([^"\n]*)"|(\w+)|(\{)|(\}))\s*$')
+
+# "[x y z offset] scale", how sides store their uaxis and vaxis
+axisPattern = re.compile(r'^\s*(\[\s*(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s*\])\s+(\S+)\s*$')
+
+def readLine(line, key):
+    # The events of one line, and the block name it leaves to be followed by a {
+    match = linePattern.match(line)
+    if match is not None and (key is None or match.group(4) is not None):
+        if match.group(1) is not None:
+            return [(KEY, match.group(1), match.group(2))], None
+        elif match.group(3) is not None:
+            return [], match.group(3)
+        elif match.group(4) is not None:
+            return [(BLOCK, key if key is not None else '')], None
+        return [(END,)], None
+    events = []
+    for kind, text, quoted in keyvalues.tokenize([line]):
+        if kind == keyvalues.STRING:
+            if key is None:
+                key = text
             else:
-                convFile.write(line)
\ No newline at end of file
+                events.append((KEY, key, text))
+                key = None
+        elif kind == keyvalues.OPEN:
+            events.append((BLOCK, key if key is not None else ''))
+            key = None
+        else:
+            events.append((END,))
+            key = None
+    return events, key
+
+def readVMF(lines):
+    # Yields the events of a .vmf, lines being any iterable of its lines (an open file reads it as it goes)
+    key = None
+    for line in lines:
+        events, key = readLine(line, key)
+        yield from events
+
+def writeVMF(events, vmfFile, depth = 0):
+    # Writes events back out the way Hammer does, a tab per level. depth is how many blocks they're already in.
+    indent = '\t' * depth
+    for event in events:
+        if event[0] == KEY:
+            vmfFile.write(indent + '"' + event[1] + '" "' + event[2] + '"\n')
+        elif event[0] == BLOCK:
+            vmfFile.write(indent + event[1] + '\n' + indent + '{\n')
+            depth += 1
+            indent = '\t' * depth
+        elif depth > 0:
+            depth -= 1
+            indent = '\t' * depth
+            vmfFile.write(indent + '}\n')
+
+def transformVMF(events, transforms, path = ()):
+    # Runs the values of events through transforms, a dict of key (lowercase): function(value, path) that returns the
+    # new value. path is the names of the blocks the key is in, i.e. ('world', 'solid', 'side'), starting from the
+    # blocks the events are already in.
+    path = list(path)
+    for event in events:
+        if event[0] == KEY:
+            transform = transforms.get(event[1].lower())
+            if transform is not None:
+                event = (KEY, event[1], transform(event[2], tuple(path)))
+        elif event[0] == BLOCK:
+            path.append(event[1].lower())
+        elif path:
+            path.pop()
+        yield event
+
+def formatNumber(value):
+    # As short as it can be without losing anything, like Hammer writes them
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+def parseAxis(value):
+    # "[x y z offset] scale" as ([x, y, z, offset], scale)
+    match = axisPattern.match(value)
+    if match is None:
+        raise ValueError('"' + value + '" is not a texture axis')
+    numbers = [float(number) for number in match.groups()[1:]]
+    return numbers[:4], numbers[4]
+
+def formatAxis(axis, scale):
+    return '[' + ' '.join(formatNumber(number) for number in axis) + '] ' + formatNumber(scale)
+
+# Transforms. They're module level functions (with their settings bound by functools.partial) so they can be sent
+# to the worker processes.
+
+def scaleTextureAxis(factor, value, path):
+    # For uaxis and vaxis: multiplies their scale (and only that) by factor. The [x y z offset] part is kept exactly
+    # as it was written.
+    match = axisPattern.match(value)
+    if match is None:
+        return value
+    try:
+        scale = float(match.group(6))
+    except ValueError:
+        return value
+    return match.group(1) + ' ' + formatNumber(scale * factor)
+
+def remapMaterial(table, value, path):
+    # For material: the .vmat a Source 1 material was converted to, from getMaterialTable(). Materials that weren't
+    # converted are left as they are.
+    return table.get(assets.normalizePath(value), value)
+
+def getMaterialsFolder(fileName):
+    # The _imported materials folder of the mod a .vmf is in, None if it isn't in a mod's maps folder
+    modPath = assets.splitModPath(fileName)
+    if modPath is None:
+        return None
+    modFolder = modPath[0]
+    if not modFolder.lower().endswith(TARGET_FOLDER_EXTENSION):
+        modFolder += TARGET_FOLDER_EXTENSION
+    return os.path.join(modFolder, 'materials')
+
+def getMaterialTable(materialsFolder):
+    # {material name as a .vmf has it (lowercase): "materials/name.vmat"} for every .vmat under materialsFolder
+    table = {}
+    for folder, dirs, files in os.walk(materialsFolder):
+        for fileName in files:
+            if fileName.lower().endswith('.vmat'):
+                name = assets.normalizePath(os.path.relpath(os.path.join(folder, fileName[:-5]), materialsFolder))
+                table[name] = 'materials/' + name + '.vmat'
+    return table
+
+def splitVMF(lines, chunkLines = CHUNK_LINES):
+    # Yields the lines of a .vmf as (lines, path of the blocks they start in) chunks of about chunkLines lines each,
+    # only ever cut after a whole top level block (entities...) or a whole solid in world
+    chunk = []
+    chunkPath = ()
+    path = []
+    key = None
+    for line in lines:
+        chunk.append(line)
+        stripped = line.strip()
+        if stripped == '{':
+            events = [(BLOCK, key if key is not None else '')]
+            key = None
+        elif stripped == '}':
+            events = [(END,)]
+            key = None
+        elif key is None and stripped[:1] == '"' and stripped.count('"') == 4:
+            continue    # a "key" "value" line, most of them, which can't start or end a block
+        else:
+            events, key = readLine(line, key)
+        for event in events:
+            if event[0] == BLOCK:
+                path.append(event[1].lower())
+            elif event[0] == END and path:
+                path.pop()
+                if len(chunk) >= chunkLines and (not path or path == ['world']):
+                    yield chunk, chunkPath
+                    chunk = []
+                    chunkPath = tuple(path)
+    if chunk:
+        yield chunk, chunkPath
+
+# The transforms of a worker process, set once when it starts instead of being sent with every chunk
+workerTransforms = None
+
+def setWorkerTransforms(transforms):
+    global workerTransforms
+    workerTransforms = transforms
+
+def convertChunk(lines, path, transforms = None):
+    # The converted text of a chunk from splitVMF()
+    text = io.StringIO()
+    writeVMF(transformVMF(readVMF(lines), transforms if transforms is not None else workerTransforms, path), text, len(path))
+    return text.getvalue()
+
+def convertVMF(fileName, convertedFileName, transforms, jobs = 1):
+    # jobs is how many processes to convert with, 0 for one per CPU core
+    jobs = jobs if jobs > 0 else os.cpu_count()
+    with open(fileName, 'r') as vmfFile, open(convertedFileName, 'w') as convFile:
+        if jobs <= 1:
+            writeVMF(transformVMF(readVMF(vmfFile), transforms), convFile)
+            return
+        # Chunks are written in the order they were read. Only a few per worker are read ahead, so memory use
+        # still doesn't grow with the size of the map.
+        with ProcessPoolExecutor(max_workers=jobs, initializer=setWorkerTransforms, initargs=(transforms,)) as executor:
+            pending = deque()
+            for lines, path in splitVMF(vmfFile):
+                pending.append(executor.submit(convertChunk, lines, path))
+                if len(pending) >= jobs * 2:
+                    convFile.write(pending.popleft().result())
+            while pending:
+                convFile.write(pending.popleft().result())
+
+def main():
+    print('Source 2 .vmf Prepper! EXPERIMENTAL!! By caseytube via Github')
+    print('Converts .vmf files to be ready for Source 2 by fixing materials')
+    print('--------------------------------------------------------------------------------------------------------')
+    argParser = argparse.ArgumentParser(description='Converts a .vmf to be ready for Source 2, written next to it as *Converted.vmf.')
+    argParser.add_argument('path', help='.vmf file to convert')
+    argParser.add_argument('--scale', type=float, default=TEXTURE_SCALE, help='what to multiply texture scales by')
+    argParser.add_argument('--materials', help='converted materials folder to take the .vmat names from '
+                           '(default: the _imported materials folder of the mod the .vmf is in)')
+    argParser.add_argument('-j', '--jobs', type=int, default=0, help='number of processes to convert with (default: one per CPU core)')
+    args = argParser.parse_args()
+
+    filename = args.path
+    convertedFilename = filename.replace(INPUT_FILE_EXT, '') + 'Converted' + INPUT_FILE_EXT
+    if not os.path.exists(filename):
+        print("input file doesn't exist")
+        quit()
+
+    print('Importing', os.path.basename(filename))
+    transforms = {
+        "uaxis": partial(scaleTextureAxis, args.scale),
+        "vaxis": partial(scaleTextureAxis, args.scale),
+    }
+    materialsFolder = args.materials or getMaterialsFolder(filename)
+    if materialsFolder is not None and os.path.isdir(materialsFolder):
+        table = getMaterialTable(materialsFolder)
+        print('Found', len(table), 'converted materials in', materialsFolder)
+        transforms["material"] = partial(remapMaterial, table)
+    else:
+        print("No converted materials folder found, materials are left as they are")
+    convertVMF(filename, convertedFilename, transforms, args.jobs)
+
+if __name__ == '__main__':
+    main()